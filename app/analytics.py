@@ -0,0 +1,170 @@
+"""Parallel per-frame analytics stage of the video pipeline."""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import os
+from pathlib import Path
+import threading
+
+from cv_nim.gdino_nim import GDINONIM
+from cv_nim.ocd_nim import OCDNIM
+from llm_nim.executor import Executor
+from utils import fair_scheduler, kitti_util
+from utils.records import set_field
+
+_pool = None
+_pool_workers = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers):
+    """Get the process pool shared by all requests."""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            context = multiprocessing.get_context("forkserver")
+            # The fork server only preloads what the workers run, not the app.
+            context.set_forkserver_preload(["app.analytics"])
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            _pool_workers = workers
+        return _pool
+
+
+def load_frame_ocd(ocd_nim, image_path, output_folder, boxes=None, padding=16):
+    """Run OCD on a single frame and return its parsed output.
+
+    With ``boxes`` only the detected regions of the frame are sent to OCD.
+    The request is queued on the fair scheduler for the current session.
+    """
+    if boxes is None:
+        fair_scheduler.run(ocd_nim.infer, image_path, output_folder)
+    else:
+        fair_scheduler.run(ocd_nim.infer_crops, image_path, boxes, output_folder, padding)
+    return ocd_nim.parse_output(Path(output_folder) / Path(image_path).stem)
+
+
+def parse_frame(frame_id, ocd_output_path, gdino_output_path, annotations_path,
+                frame_text=None, tracks=None, records=False):
+    """Read a frame's detections and associate the OCD text with them.
+
+    The Grounding DINO detections are also written as a KITTI file in the
+    annotations directory, where the overlay stage picks them up. Without an
+    ``ocd_output_path`` the detections carry no text, unless a lazy
+    ``frame_text`` is given. With the frame's ``tracks`` every detection gets
+    its track_id, and tracked objects that haven't moved take their text from
+    the frame it was read on. With ``records`` the detections are compact
+    read-only records instead of dictionaries.
+    """
+    ocd_metadata = None
+    if ocd_output_path is not None:
+        ocd_metadata = OCDNIM(None).parse_output(Path(ocd_output_path) / frame_id, records=records)
+    kitti_file = os.path.join(annotations_path, frame_id + ".txt")
+    GDINONIM(None).parse_output(Path(gdino_output_path) / frame_id, output_file=kitti_file)
+    metadata = kitti_util.read_kitti(kitti_file, ocd_data=ocd_metadata, frame_text=frame_text, records=records)
+    if tracks is None:
+        return metadata
+
+    anchor_ocd = {}
+    for detection, (track_id, anchor_frame_id, anchor_bbox) in zip(metadata, tracks):
+        set_field(detection, "track_id", track_id)
+        if ocd_metadata is None or anchor_frame_id == frame_id:
+            continue
+        if anchor_frame_id not in anchor_ocd:
+            anchor_ocd[anchor_frame_id] = OCDNIM(None).parse_output(
+                Path(ocd_output_path) / anchor_frame_id, records=records
+            )
+        set_field(detection, "object_text", kitti_util.associate_text(anchor_ocd[anchor_frame_id], anchor_bbox))
+    return metadata
+
+
+def _analyze_chunk(frame_ids, frame_tracks, ocd_output_path, gdino_output_path, annotations_path,
+                   function_string, function_name, memoize, quantization, memo_size, records):
+    """Parse a chunk of frames and run the postprocessor on them."""
+    metadata_list = [
+        parse_frame(
+            frame_id, ocd_output_path, gdino_output_path, annotations_path,
+            tracks=frame_tracks.get(frame_id), records=records
+        )
+        for frame_id in frame_ids
+    ]
+    if function_string is None:
+        return [(metadata, None) for metadata in metadata_list]
+    Executor.result_cache.max_entries = memo_size
+    code_executor = Executor(function_name=function_name, memoize=memoize, quantization=quantization)
+    code_executor.load_function_from_string(function_string)
+    if code_executor.postprocessor is None:
+        raise RuntimeError(f"Couldn't load {function_name}:\n{code_executor.error}")
+    return list(zip(metadata_list, code_executor.execute_batch(metadata_list)))
+
+
+def iter_analyze_frames(frame_ids, ocd_output_path, gdino_output_path, annotations_path,
+                        function_string=None, function_name="postprocessor",
+                        workers=0, chunk_size=8,
+                        memoize=False, quantization=0.0, memo_size=4096, tracks=None, records=False):
+    """Parse frames and run the postprocessor across a process pool, chunk by chunk.
+
+    Yields the frame ids of every chunk with their ``(metadata, result)``
+    pairs as soon as the chunk is done, so chunks may arrive out of order.
+    The arguments are the ones of ``analyze_frames``.
+    """
+    tracks = tracks or {}
+    workers = workers or os.cpu_count()
+    chunks = [
+        frame_ids[index:index + chunk_size]
+        for index in range(0, len(frame_ids), chunk_size)
+    ]
+    arguments = (
+        ocd_output_path, gdino_output_path, annotations_path,
+        function_string, function_name, memoize, quantization, memo_size, records
+    )
+    if workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            yield chunk, _analyze_chunk(chunk, {frame_id: tracks.get(frame_id) for frame_id in chunk}, *arguments)
+        return
+
+    pool = _get_pool(workers)
+    futures = {
+        pool.submit(_analyze_chunk, chunk, {frame_id: tracks.get(frame_id) for frame_id in chunk}, *arguments): chunk
+        for chunk in chunks
+    }
+    try:
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def analyze_frames(frame_ids, ocd_output_path, gdino_output_path, annotations_path,
+                   function_string=None, function_name="postprocessor",
+                   workers=0, chunk_size=8,
+                   memoize=False, quantization=0.0, memo_size=4096, tracks=None, records=False):
+    """Parse frames and run the postprocessor across a process pool.
+
+    Frames are sent to the pool in chunks of ``chunk_size``. Returns one
+    ``(metadata, result)`` pair per frame, in frame order. Without a
+    ``function_string`` the frames are only parsed and the results are None.
+    With a single worker everything runs in this process. Memoized results
+    live in each worker, so they carry over to later videos on the same pool.
+    ``tracks`` maps frame ids to the output of ``utils.tracker.assign_tracks``.
+    With ``records`` the metadata holds compact ``Detection`` records.
+    """
+    pairs = {}
+    for chunk, chunk_result in iter_analyze_frames(
+            frame_ids, ocd_output_path, gdino_output_path, annotations_path,
+            function_string=function_string, function_name=function_name,
+            workers=workers, chunk_size=chunk_size,
+            memoize=memoize, quantization=quantization, memo_size=memo_size,
+            tracks=tracks, records=records):
+        pairs.update(zip(chunk, chunk_result))
+    return [pairs[frame_id] for frame_id in frame_ids]
+
+
+def write_analytics(analytics_path, frame_ids, results):
+    """Write the per-frame analytics files in one pass."""
+    os.makedirs(analytics_path, exist_ok=True)
+    for frame_id, result in zip(frame_ids, results):
+        with open(os.path.join(analytics_path, frame_id + ".txt"), "w") as fo:
+            fo.write(str(result))
@@ -1,3 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from functools import partial
 import glob
 import gradio as gr
 import json
@@ -6,22 +9,36 @@ import os
 import shutil
 from pathlib import Path
 import tempfile
-from tqdm import tqdm
 import pandas as pd
 
-from llm_nim.openai_nim import InstructionalNIM, NounChunkNIM
+from llm_nim.code_inspection import required_fields
 from llm_nim.executor import Executor
+from llm_nim.metrics import llm_metrics, serve_metrics
+from llm_nim.openai_nim import OpenAINIM
 from nvidia_tao_pytorch.core.hydra.hydra_runner import hydra_runner
 # from primary_cv.model_handler import ModelInstance
 # from primary_cv.gdino_infer import infer as model_inference
-from cv_nim.ocd_nim import OCDNIM
-from cv_nim.gdino_nim import GDINONIM
+from app import analytics, early_exit
+from app.pipeline import (
+    create_gdino_nim,
+    create_ocd_nim,
+    create_results_store,
+    create_sandbox_pool,
+    create_scheduler,
+    extract_noun_chunks,
+    generate_analytics,
+    generate_video_analytics
+)
 from schema.default_config import GradioApp
-from utils.constants import NVCF_API, URL
-from utils import kitti_util
+from utils.results_store import file_hash
+from utils.serving import JobQueue, Overloaded, request_user
+from utils import fair_scheduler, kitti_util, rate_limit, tracker
 from utils.utils import execute_command
 
 SAMPLING_FPS = 3
+sandbox_pool = None
+job_queue = None
+results_store = None
 
 logging.basicConfig(
     format='[%(asctime)s] [TAO Toolkit] [MM] [%(name)s] [%(levelname)s]: %(message)s',
@@ -43,116 +60,330 @@ def exit_cleanup(intermediate_paths):
         shutil.rmtree(path)
 
 
-def extract_noun_chunks(prompt):
-    """Extract noun chunks from user prompt."""
-    noun_chunk_extractor = NounChunkNIM(
-        URL, NVCF_API
-    )
-    base_prompt = noun_chunk_extractor.get_base_prompt()
-    compiled_prompt = f"{base_prompt} Given text: {prompt}"
-    noun_chunk_extractor.assign_model("meta/llama3-70b-instruct")
-    data = noun_chunk_extractor.infer(compiled_prompt)
-    return data["noun_chunks"]
+def analyze_video(question, noun_chunks, frames_dir, frame_ids, model_output_path, annotations_path,
+                  ocd_output_path=None):
+    """Run the CV NIMs and the generated postprocessor on the frames of a video.
 
+    Yields ``(frame_ids, results)`` as frames complete and returns the answer
+    for the whole video in the modes that produce one. Whole frame OCD outputs
+    already in ``ocd_output_path`` are reused.
+    """
+    gdino_nim = create_gdino_nim(demo_configuration.cv)
+    gdino_output_path = Path(model_output_path) / "gdino_inference"
+    ocd_nim = create_ocd_nim(demo_configuration.cv)
+    reuse_ocd = ocd_output_path is not None
+    ocd_output_path = Path(ocd_output_path or Path(model_output_path) / "ocd_inference")
+    analytics_config = demo_configuration.analytics
+    cv_config = demo_configuration.cv
+    ocd_mode = cv_config.ocd_mode
+    records = analytics_config.compact_records
 
-def generate_analytics(metadata: dict, question: str, code_executor: Executor):
-    """Run and cache codellama code for each frame."""
-    instructional_nim = InstructionalNIM(
-        URL, NVCF_API
+    # The first frame generates the postprocessor, the rest are analyzed in parallel.
+    code_executor = Executor(
+        sandbox=sandbox_pool,
+        memoize=analytics_config.memoize,
+        quantization=analytics_config.quantization
     )
-    if not code_executor.postprocessor:
-        instructional_nim.assign_model(
-           "mistralai/codestral-22b-instruct-v0.1"
+    if analytics_config.mode == "early_exit":
+        # Frames are inferred in a coarse-to-fine order until the answer is settled.
+        evaluated, results, video_answer = early_exit.answer_question(
+            frame_ids, frames_dir, noun_chunks, question,
+            gdino_nim, ocd_nim, gdino_output_path, ocd_output_path, annotations_path,
+            code_executor,
+            llm_config=demo_configuration.llm,
+            cv_config=cv_config,
+            workers=analytics_config.early_exit_workers,
+            frame_order=analytics_config.frame_order,
+            records=records
         )
-        base_prompt = instructional_nim.get_base_prompt()
-        compiled_prompt = base_prompt.format(
-            bbox_prompt=json.dumps(metadata),
-            codellama_prompt=question
+        yield evaluated, results
+        return video_answer
+
+    #Inference Grounding Dino
+    gdino_nim.batch_infer(frames_dir, noun_chunks, gdino_output_path)
+
+    #Inference OCD
+    frame_boxes = None
+    frame_tracks = None
+    ocd_boxes = None
+    if cv_config.ocd_crops or cv_config.tracking:
+        frame_detections = {
+            frame_id: gdino_nim.read_detections(gdino_output_path / frame_id) for frame_id in frame_ids
+        }
+        frame_boxes = {
+            frame_id: [bbox for _, bbox in detections] for frame_id, detections in frame_detections.items()
+        }
+        # OCD only looks at what Grounding DINO detected.
+        ocd_boxes = frame_boxes
+    if cv_config.tracking:
+        frame_tracks = tracker.assign_tracks(
+            frame_ids, frame_detections,
+            iou_threshold=cv_config.track_iou_threshold,
+            reuse_iou=cv_config.text_reuse_iou,
+            max_age=cv_config.track_max_age
         )
-        function_string = instructional_nim.infer(compiled_prompt)
-        code_executor.load_function_from_string(
-            function_string
+        # Only new tracks and tracks that moved away from where their text
+        # was read go through OCD again.
+        ocd_boxes = {
+            frame_id: [
+                bbox for bbox, (_, anchor_frame_id, _) in zip(frame_boxes[frame_id], frame_tracks[frame_id])
+                if anchor_frame_id == frame_id
+            ]
+            for frame_id in frame_ids
+        }
+    ocd_arguments = dict(boxes=ocd_boxes, padding=cv_config.crop_padding)
+    if ocd_mode == "eager" or analytics_config.mode == "video":
+        ocd_nim.batch_infer(frames_dir, ocd_output_path, workers=16, skip_existing=reuse_ocd, **ocd_arguments)
+    else:
+        # The postprocessor is generated on the first frame, the generated
+        # code then decides whether the other frames need OCD at all.
+        analytics.load_frame_ocd(
+            ocd_nim, os.path.join(frames_dir, frame_ids[0] + ".png"), ocd_output_path,
+            boxes=ocd_boxes and ocd_boxes[frame_ids[0]], padding=cv_config.crop_padding
         )
-    return code_executor.execute(metadata), code_executor
 
+    if analytics_config.mode == "video":
+        # One postprocessor call over the detections of the whole video.
+        frame_metadata = [
+            metadata for metadata, _ in analytics.analyze_frames(
+                frame_ids, ocd_output_path, gdino_output_path, annotations_path,
+                workers=analytics_config.workers,
+                chunk_size=analytics_config.chunk_size,
+                tracks=frame_tracks,
+                records=records
+            )
+        ]
+        video = kitti_util.build_video_columns(frame_metadata, frame_ids, SAMPLING_FPS)
+        (results, video_answer), code_executor = generate_video_analytics(
+            video, question, code_executor=code_executor, llm_config=demo_configuration.llm
+        )
+        yield frame_ids, results
+        return video_answer
+
+    metadata = analytics.parse_frame(
+        frame_ids[0], ocd_output_path, gdino_output_path, annotations_path,
+        tracks=frame_tracks and frame_tracks[frame_ids[0]],
+        records=records
+    )
+    logging.debug(f"Object Level Metadata: \n{metadata}")
+    result, code_executor = generate_analytics(
+        metadata, question, code_executor=code_executor, llm_config=demo_configuration.llm
+    )
+    yield frame_ids[:1], [result]
+
+    fields = required_fields(code_executor.source)
+    reads_text = fields is None or "object_text" in fields
+    frame_ocd_path = ocd_output_path
+    if ocd_mode != "eager" and not reads_text:
+        logger.info("The postprocessor doesn't read object_text, skipping OCD.")
+        frame_ocd_path = None
+    elif ocd_mode == "lazy" and fields is not None and not sandbox_pool:
+        # Detections resolve their text on first read, so OCD only
+        # runs on the frames whose text the postprocessor looks at.
+        def evaluate(frame_id):
+            frame_text = kitti_util.LazyFrameText(partial(
+                analytics.load_frame_ocd, ocd_nim,
+                os.path.join(frames_dir, frame_id + ".png"), ocd_output_path,
+                boxes=frame_boxes[frame_id] if cv_config.ocd_crops else None,
+                padding=cv_config.crop_padding
+            ))
+            frame_metadata = analytics.parse_frame(
+                frame_id, None, gdino_output_path, annotations_path,
+                frame_text=frame_text, tracks=frame_tracks and frame_tracks[frame_id],
+                records=records
+            )
+            # Memoizing would hash, and so read, the text of every detection.
+            return code_executor.postprocessor(frame_metadata)
+
+        # Frames are evaluated concurrently, as many as the OCD workers of
+        # the eager mode, so that their OCD requests overlap. Results are
+        # still streamed in frame order.
+        remaining = frame_ids[1:]
+        chunk_size = analytics_config.chunk_size
+        executor = ThreadPoolExecutor(max_workers=16)
+        try:
+            futures = [
+                executor.submit(contextvars.copy_context().run, evaluate, frame_id) for frame_id in remaining
+            ]
+            for index in range(0, len(remaining), chunk_size):
+                yield remaining[index:index + chunk_size], [
+                    future.result() for future in futures[index:index + chunk_size]
+                ]
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return None
+    elif ocd_mode != "eager":
+        ocd_nim.batch_infer(frames_dir, ocd_output_path, workers=16, skip_existing=True, **ocd_arguments)
+
+    for chunk, frame_results in analytics.iter_analyze_frames(
+            frame_ids[1:], frame_ocd_path, gdino_output_path, annotations_path,
+            # Sandboxed postprocessors only run in the sandbox pool.
+            function_string=None if sandbox_pool else code_executor.source,
+            workers=analytics_config.workers,
+            chunk_size=analytics_config.chunk_size,
+            memoize=analytics_config.memoize,
+            quantization=analytics_config.quantization,
+            memo_size=analytics_config.memo_size,
+            tracks=frame_tracks,
+            records=records):
+        if sandbox_pool:
+            yield chunk, code_executor.execute_batch([metadata for metadata, _ in frame_results])
+        else:
+            yield chunk, [frame_result for _, frame_result in frame_results]
+    return None
+
+
+def results_table(frame_results, video_answer=None, final=False):
+    """Table of the per-frame LLM outputs, in frame order.
+
+    The final table also holds the answer for the whole video in the modes
+    that produce one.
+    """
+    frame_ids = sorted(frame_results)
+    table = pd.DataFrame({
+        "Frame ID": frame_ids,
+        "LLM Output": [str(frame_results[frame_id]) for frame_id in frame_ids]
+    })
+    if final and demo_configuration.analytics.mode in ("video", "early_exit"):
+        table.loc[len(table)] = ["Video", str(video_answer)]
+    return table
 
-def run_demo(input_video_path, question):
-    """Run the gradio demo."""
-    frames_dir = tempfile.mkdtemp()
-    model_output_path = tempfile.mkdtemp()
-    output_video_path = tempfile.mkdtemp()
-    inference_output_path = tempfile.mkdtemp()
-    overlayn_image_path = tempfile.mkdtemp()
-    
-    # fed into Grounding DINO.
-    noun_chunks = extract_noun_chunks(question)
-    logging.info(f"Noun Chunks: {noun_chunks}")
+
+def run_demo(input_video_path, question, session=None):
+    """Run the gradio demo.
+
+    Yields the table of the frames analyzed so far and a preview of the last
+    annotated frame as frames complete, then the encoded video at the end.
+    With the results store, a question already answered on the same video is
+    answered from the store, and a new question on a known video reuses its
+    extracted frames and OCD outputs. With the fair scheduler, the NIM
+    requests are queued for ``session``.
+    """
+    cv_config = demo_configuration.cv
+    frame_params = {"fps": SAMPLING_FPS}
+    answer_params = dict(
+        frame_params, mode=demo_configuration.analytics.mode, threshold=cv_config.detection_threshold
+    )
+    video_hash = None
+    if results_store is not None:
+        video_hash = file_hash(input_video_path)
+        stored = results_store.get_answer(video_hash, answer_params, question)
+        if stored is not None:
+            logger.info("Answered from the results store.")
+            yield stored["video_path"], results_table(
+                stored["frame_results"], stored["video_answer"], final=True
+            ), None
+            return
+
+    llm_events = llm_metrics.start_request()
+    fair_scheduler.set_session(session, priority=demo_configuration.scheduler.video_priority)
+    # Gradio may resume this generator on another thread, so the analysis
+    # always runs in the context the request's LLM calls are recorded in.
+    request_context = contextvars.copy_context()
+    # Set up inside the try, so that a failure at any point releases what was
+    # already pinned or created.
+    stored_frames = False
+    frames_dir = ocd_output_path = None
+    model_output_path = inference_output_path = overlayn_image_path = None
 
     try:
-        ffmpeg_command = f"ffmpeg -i {input_video_path} -vf \"fps={SAMPLING_FPS}\" {frames_dir}/frame_%05d.png"
-        assert execute_command(ffmpeg_command), (
-            "Video wasn't serialized to run inference."
-        )
+        # Stored frames are pinned while in use, so concurrent runs don't evict them.
+        frames_dir = results_store and results_store.get_artifact(video_hash, frame_params, "frames", pin=True)
+        stored_frames = frames_dir is not None
+        if not stored_frames:
+            frames_dir = tempfile.mkdtemp()
+        if results_store is not None and not cv_config.ocd_crops and not cv_config.tracking:
+            # Only whole frame OCD outputs hold for any question. They are staged
+            # from the stored ones and only stored back once the run succeeded.
+            ocd_output_path = tempfile.mkdtemp()
+            results_store.copy_artifact(video_hash, frame_params, "ocd", ocd_output_path)
+        model_output_path = tempfile.mkdtemp()
+        output_video_path = tempfile.mkdtemp()
+        inference_output_path = tempfile.mkdtemp()
+        overlayn_image_path = tempfile.mkdtemp()
 
-        #Inference Grounding Dino
-        gdino_nim = GDINONIM(NVCF_API)
-        gdino_output_path = Path(model_output_path) / "gdino_inference"
-        gdino_nim.batch_infer(frames_dir, noun_chunks, gdino_output_path)
+        # fed into Grounding DINO.
+        noun_chunks = extract_noun_chunks(question)
+        logging.info(f"Noun Chunks: {noun_chunks}")
+
+        if stored_frames:
+            logger.info("Reusing the frames extracted from this video.")
+        else:
+            ffmpeg_command = f"ffmpeg -i {input_video_path} -vf \"fps={SAMPLING_FPS}\" {frames_dir}/frame_%05d.png"
+            assert execute_command(ffmpeg_command), (
+                "Video wasn't serialized to run inference."
+            )
+            if results_store is not None:
+                frames_dir = results_store.put_artifact(video_hash, frame_params, "frames", frames_dir, pin=True)
+                stored_frames = True
 
-        #Inference OCD
-        ocd_nim = OCDNIM(NVCF_API)
-        ocd_output_path = Path(model_output_path) / "ocd_inference"
-        ocd_nim.batch_infer(frames_dir, ocd_output_path, workers=16)
         analytics_path = os.path.join(model_output_path, "analytics")
-        os.makedirs(analytics_path, exist_ok=True)
         annotations_path = os.path.join(model_output_path, "inference/labels")
-        frame_files = glob.iglob(os.path.join(annotations_path, "*.txt"))
-        code_executor = Executor()
-        output_frame_responses = {"Frame ID": [], "LLM Output": []}
-        for frame in tqdm(frame_files):
-            #Read OCD/OCR metadata 
-            ocd_metadata = ocd_nim.parse_output(ocd_output_path/Path(frame).stem)
-
-            #Grounding dino metadata
-            metadata = kitti_util.read_kitti(
-                os.path.join(annotations_path, frame), ocd_data=ocd_metadata
-            )
-            logging.debug(f"Object Level Metadata: \n{metadata}")
+        os.makedirs(annotations_path, exist_ok=True)
+        frame_ids = sorted(Path(frame).stem for frame in glob.iglob(os.path.join(frames_dir, "*.png")))
+
+        frame_results = {}
+        video_answer = None
+        preview = None
+        updates = analyze_video(
+            question, noun_chunks, frames_dir, frame_ids, model_output_path, annotations_path,
+            ocd_output_path=ocd_output_path
+        )
+        while frame_ids:
+            try:
+                update_ids, update_results = request_context.run(next, updates)
+            except StopIteration as stop:
+                video_answer = stop.value
+                break
+            analytics.write_analytics(analytics_path, update_ids, update_results)
+            frame_results.update(zip(update_ids, update_results))
 
-            analytic_label = Path(analytics_path)/ (Path(frame).stem + ".txt")
-            print(f"Analytic label: {analytic_label}")
-            with open(analytic_label, "w+") as fo:
-                result, code_executor = generate_analytics(metadata, question, code_executor=code_executor)
-                fo.write(str(result))
+            # Overlay the annotation on the image
+            for frame_id in update_ids:
+                preview = kitti_util.overlay_label_on_image(
+                    os.path.join(frames_dir, frame_id + ".png"),
+                    os.path.join(analytics_path, frame_id + ".txt"),
+                    os.path.join(overlayn_image_path, frame_id + ".png"),
+                    os.path.join(annotations_path, frame_id + ".txt")
+                )
+            yield None, results_table(frame_results), preview
 
-                #create table output for llm responses. 
-                output_frame_responses["Frame ID"].append(Path(frame).stem)
-                output_frame_responses["LLM Output"].append(str(result))
-        
-        # Overlay the annotation on the image
-        kitti_util.overlay_labels_on_images(frames_dir, analytics_path, overlayn_image_path, detection_dir=Path(model_output_path)/"inference/labels")
+        #create table output for llm responses. 
+        output_frame_responses = results_table(frame_results, video_answer, final=True)
 
         # Concatenate command for ffmpeg
         output_video_file = f"{output_video_path}/gradio_output_video.mp4"
         ffmpeg_command = (
-            f"ffmpeg -y -framerate {SAMPLING_FPS} -i {overlayn_image_path}/frame_%05d.png "  # Input frames
+            f"ffmpeg -y -framerate {SAMPLING_FPS} -pattern_type glob -i '{overlayn_image_path}/frame_*.png' "  # Input frames
             f"-c:v libx264 -pix_fmt yuv420p {output_video_file}"  # Output video codec and format
         )
         
         # Execute ffmpeg command
         execute_command(ffmpeg_command)
-        return output_video_file, pd.DataFrame(output_frame_responses)  # Return the path to the generated video file & llm response table
+        if results_store is not None:
+            if ocd_output_path is not None:
+                results_store.put_artifact(video_hash, frame_params, "ocd", ocd_output_path, replace=True)
+            if os.path.exists(output_video_file):
+                results_store.put_answer(
+                    video_hash, answer_params, question, frame_results, video_answer, output_video_file
+                )
+        yield output_video_file, output_frame_responses, preview  # Yield the path to the generated video file & llm response table
     
-    except Exception as e:
-        raise e
     finally:
+        logger.info(f"LLM calls: {json.dumps(llm_metrics.summarize(llm_events))}")
         intermediate_paths = [
-            frames_dir,
             model_output_path,
             inference_output_path,
             overlayn_image_path,
+            ocd_output_path,
         ]
-        exit_cleanup(intermediate_paths=intermediate_paths)
+        if stored_frames:
+            results_store.release(video_hash, frame_params, "frames")
+        else:
+            intermediate_paths.append(frames_dir)
+        exit_cleanup(intermediate_paths=[
+            path for path in intermediate_paths if path is not None and os.path.exists(path)
+        ])
 
 
 # def pull_and_cache_models(model_instance_config):
@@ -167,6 +398,19 @@ def run_demo(input_video_path, question):
 #     return model_instance
 
 
+def serve_demo(input_video_path, question, request: gr.Request, progress=gr.Progress()):
+    """Queue a demo run for the requesting user."""
+    try:
+        user = request_user(request)
+        yield from job_queue.stream(
+            user, run_demo, input_video_path, question,
+            on_wait=lambda position: progress(0, desc=f"Waiting in queue, position {position}"),
+            session=user
+        )
+    except Overloaded as error:
+        raise gr.Error(str(error))
+
+
 @hydra_runner(
     config_path=config_root,
     config_name="config.yaml",
@@ -179,6 +423,14 @@ def main(cfg: GradioApp):
     model_instances = {}
     global demo_configuration
     demo_configuration = cfg
+    OpenAINIM.set_max_concurrency(cfg.llm.max_concurrency)
+    rate_limit.configure(cfg.rate_limits.endpoints)
+    create_scheduler(cfg.scheduler)
+    global sandbox_pool
+    sandbox_pool = create_sandbox_pool(cfg.sandbox)
+    global results_store
+    results_store = create_results_store(cfg.results_store)
+    Executor.result_cache.max_entries = cfg.analytics.memo_size
     # for instance_config in model_config:
     #     model_instances[instance_config.name] = pull_and_cache_models(instance_config)
 
@@ -187,20 +439,37 @@ def main(cfg: GradioApp):
         gr.Textbox(label="Query")
     ]
     app_config = cfg.app
+    if app_config.metrics_port:
+        serve_metrics(app_config.metrics_port, app_config.server_name)
+        logger.info(f"Serving LLM metrics on port {app_config.metrics_port}.")
+    global job_queue
+    job_queue = JobQueue(
+        concurrency=app_config.concurrency_limit,
+        max_queue_size=app_config.max_queue_size,
+        max_jobs_per_user=app_config.max_jobs_per_user
+    )
 
     outputs = [
         gr.Video(), 
-        gr.Dataframe(headers=["Frame ID", "LLM Output"])
+        gr.Dataframe(headers=["Frame ID", "LLM Output"]),
+        gr.Image(label="Latest Frame")
     ]
-    gr.Interface(
-        fn=run_demo,
+    demo = gr.Interface(
+        fn=serve_demo,
         inputs=inputs,
         outputs=outputs,
-        title="Frame Annotation Video Renderer").launch(
-            server_port=app_config.server_port,
-            server_name=app_config.server_name,
-            debug=app_config.debug
-        )
+        title="Frame Annotation Video Renderer")
+    # Gradio hands requests over right away, the job queue orders and limits them.
+    demo.queue(
+        default_concurrency_limit=app_config.concurrency_limit + app_config.max_queue_size,
+        max_size=app_config.max_queue_size
+    ).launch(
+        server_port=app_config.server_port,
+        server_name=app_config.server_name,
+        debug=app_config.debug,
+        # Stored answers are served from the store.
+        allowed_paths=[str(results_store.root)] if results_store is not None else None
+    )
 
 
 if __name__ == "__main__":
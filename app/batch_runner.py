@@ -0,0 +1,257 @@
+"""Headless runner answering a list of questions on a batch of videos.
+
+Every video goes through frame extraction, Grounding DINO and OCD once. The
+Grounding DINO prompt is the union of the noun chunks of all questions, and
+every question's postprocessor then only sees the detections of its own
+noun chunks. Postprocessors are generated once per question and reused on
+every video.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import copy
+import glob
+import logging
+import os
+from pathlib import Path
+import shlex
+import shutil
+import tempfile
+import threading
+
+import pandas as pd
+
+from app import analytics
+from app.pipeline import (
+    aextract_noun_chunks,
+    create_gdino_nim,
+    create_ocd_nim,
+    create_sandbox_pool,
+    create_scheduler,
+    generate_analytics,
+    generate_video_analytics
+)
+from cv_nim.gdino_nim import phrase_chunk
+from llm_nim.executor import Executor
+from llm_nim.openai_nim import OpenAINIM
+from nvidia_tao_pytorch.core.hydra.hydra_runner import hydra_runner
+from schema.default_config import GradioApp
+from utils import fair_scheduler, kitti_util, rate_limit
+from utils.utils import execute_command
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".webm")
+RESULT_COLUMNS = ["video", "question", "frame_id", "result", "error"]
+
+logging.basicConfig(
+    format='[%(asctime)s] [TAO Toolkit] [MM] [%(name)s] [%(levelname)s]: %(message)s',
+    level='INFO'
+)
+logger = logging.getLogger(__name__)
+
+config_root = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config")
+
+
+def list_videos(videos):
+    """Videos of a directory, or listed one per line in a manifest file."""
+    if os.path.isdir(videos):
+        return sorted(
+            str(path) for path in Path(videos).iterdir() if path.suffix.lower() in VIDEO_EXTENSIONS
+        )
+    manifest_dir = Path(videos).parent
+    with open(videos) as manifest:
+        lines = [line.strip() for line in manifest]
+    return [str(manifest_dir / line) for line in lines if line and not line.startswith("#")]
+
+
+def read_questions(questions_file):
+    """Questions listed one per line."""
+    with open(questions_file) as questions:
+        return [line.strip() for line in questions if line.strip() and not line.startswith("#")]
+
+
+async def extract_all_noun_chunks(questions):
+    """Noun chunks of every question, extracted concurrently on one event loop."""
+    return await asyncio.gather(*(aextract_noun_chunks(question) for question in questions))
+
+
+def union_noun_chunks(question_chunks):
+    """Noun chunks of all the questions, without duplicates, in order of appearance."""
+    return list(dict.fromkeys(chunk for chunks in question_chunks.values() for chunk in chunks))
+
+
+def matches_noun_chunk(class_name, noun_chunks, prompt_chunks):
+    """Whether a Grounding DINO phrase comes from one of the noun chunks of a question.
+
+    The phrase is attributed to one of the ``prompt_chunks`` it was detected
+    for, by exact text or shared words, as the detection cache does.
+    """
+    return phrase_chunk(class_name, prompt_chunks) in noun_chunks
+
+
+def select_detections(metadata, noun_chunks, prompt_chunks):
+    """Detections of a frame whose class comes from the noun chunks of a question."""
+    return [
+        detection for detection in metadata
+        if matches_noun_chunk(detection["class_name"], noun_chunks, prompt_chunks)
+    ]
+
+
+class BatchRunner:
+    """Answers every question on every video, sharing inference between questions."""
+
+    def __init__(self, cfg, questions, sandbox_pool=None):
+        """Constructor."""
+        self.cfg = cfg
+        self.questions = questions
+        self.noun_chunks = dict(zip(questions, asyncio.run(extract_all_noun_chunks(questions))))
+        self.prompt_chunks = union_noun_chunks(self.noun_chunks)
+        self.prompt = ",".join(self.prompt_chunks)
+        logger.info(f"Noun Chunks: {self.noun_chunks}")
+        # One postprocessor per question, generated on the first video that reaches it.
+        self.executors = {
+            question: Executor(
+                sandbox=sandbox_pool,
+                memoize=cfg.analytics.memoize,
+                quantization=cfg.analytics.quantization
+            )
+            for question in questions
+        }
+        self.locks = {question: threading.Lock() for question in questions}
+
+    def infer_video(self, frames_dir, model_output_path):
+        """Run Grounding DINO and OCD once on every frame and return the parsed frames."""
+        cv_config = self.cfg.cv
+        gdino_nim = create_gdino_nim(cv_config)
+        gdino_output_path = Path(model_output_path) / "gdino_inference"
+        ocd_output_path = Path(model_output_path) / "ocd_inference"
+        annotations_path = os.path.join(model_output_path, "labels")
+        os.makedirs(annotations_path, exist_ok=True)
+        frame_ids = sorted(Path(frame).stem for frame in glob.iglob(os.path.join(frames_dir, "*.png")))
+
+        gdino_nim.batch_infer(frames_dir, self.prompt, gdino_output_path)
+        ocd_boxes = None
+        if cv_config.ocd_crops:
+            ocd_boxes = {frame_id: gdino_nim.read_boxes(gdino_output_path / frame_id) for frame_id in frame_ids}
+        create_ocd_nim(cv_config).batch_infer(
+            frames_dir, ocd_output_path, workers=16, boxes=ocd_boxes, padding=cv_config.crop_padding
+        )
+        frame_metadata = [
+            metadata for metadata, _ in analytics.analyze_frames(
+                frame_ids, ocd_output_path, gdino_output_path, annotations_path,
+                workers=self.cfg.analytics.workers,
+                chunk_size=self.cfg.analytics.chunk_size,
+                records=self.cfg.analytics.compact_records
+            )
+        ]
+        return frame_ids, frame_metadata
+
+    def answer(self, question, frame_ids, frame_metadata):
+        """Per-frame results of a question and its answer for the whole video, if any."""
+        # Every question gets its own copy, so a postprocessor that changes its
+        # input doesn't change what the other questions see.
+        metadata_list = [
+            copy.deepcopy(select_detections(metadata, self.noun_chunks[question], self.prompt_chunks))
+            for metadata in frame_metadata
+        ]
+        code_executor = self.executors[question]
+        llm_config = self.cfg.llm
+        if self.cfg.analytics.mode == "video":
+            video = kitti_util.build_video_columns(metadata_list, frame_ids, self.cfg.batch.sampling_fps)
+            with self.locks[question]:
+                (results, video_answer), _ = generate_video_analytics(
+                    video, question, code_executor=code_executor, llm_config=llm_config
+                )
+            return results, video_answer
+        with self.locks[question]:
+            first_result, _ = generate_analytics(
+                metadata_list[0], question, code_executor=code_executor, llm_config=llm_config
+            )
+        return [first_result] + code_executor.execute_batch(metadata_list[1:]), None
+
+    def run_video(self, video_path):
+        """Answer every question on a video and return the result rows."""
+        # With the fair scheduler, videos share the NIM requests evenly.
+        fair_scheduler.set_session(video_path)
+        frames_dir = tempfile.mkdtemp()
+        model_output_path = tempfile.mkdtemp()
+        try:
+            ffmpeg_command = (
+                f"ffmpeg -i {shlex.quote(video_path)} -vf \"fps={self.cfg.batch.sampling_fps}\" "
+                f"{frames_dir}/frame_%05d.png"
+            )
+            if not execute_command(ffmpeg_command):
+                raise RuntimeError(f"Couldn't extract the frames of {video_path}.")
+            frame_ids, frame_metadata = self.infer_video(frames_dir, model_output_path)
+            if not frame_ids:
+                raise RuntimeError(f"No frames were extracted from {video_path}.")
+
+            rows = []
+            for question in self.questions:
+                try:
+                    results, video_answer = self.answer(question, frame_ids, frame_metadata)
+                except Exception as error:
+                    logger.exception(f"Couldn't answer {question!r} on {video_path}.")
+                    rows.append([video_path, question, None, None, str(error)])
+                    continue
+                rows += [
+                    [video_path, question, frame_id, str(result), None]
+                    for frame_id, result in zip(frame_ids, results)
+                ]
+                if self.cfg.analytics.mode == "video":
+                    rows.append([video_path, question, "Video", str(video_answer), None])
+            return rows
+        finally:
+            shutil.rmtree(frames_dir, ignore_errors=True)
+            shutil.rmtree(model_output_path, ignore_errors=True)
+
+    def run(self, videos):
+        """Answer every question on every video, ``batch.video_workers`` videos at a time."""
+        rows = []
+        with ThreadPoolExecutor(max_workers=self.cfg.batch.video_workers) as executor:
+            futures = {executor.submit(self.run_video, video_path): video_path for video_path in videos}
+            for future in as_completed(futures):
+                try:
+                    rows += future.result()
+                except Exception as error:
+                    logger.exception(f"Couldn't process {futures[future]}.")
+                    rows += [[futures[future], question, None, None, str(error)] for question in self.questions]
+        # Rows of a video are in question and frame order, videos in completion order.
+        return pd.DataFrame(rows, columns=RESULT_COLUMNS).sort_values("video", kind="stable").reset_index(drop=True)
+
+
+def write_results(results, output_path):
+    """Write the results as Parquet, or as CSV for any other extension."""
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    if output_path.endswith(".parquet"):
+        results.to_parquet(output_path, index=False)
+    else:
+        results.to_csv(output_path, index=False)
+
+
+@hydra_runner(
+    config_path=config_root,
+    config_name="config.yaml",
+    schema=GradioApp
+)
+def main(cfg: GradioApp):
+    """Answer the questions of ``batch.questions`` on the videos of ``batch.videos``."""
+    if cfg.analytics.mode not in ("frame", "video"):
+        logger.info(f"The {cfg.analytics.mode} mode isn't supported in batches, analyzing every frame.")
+        cfg.analytics.mode = "frame"
+    OpenAINIM.set_max_concurrency(cfg.llm.max_concurrency)
+    rate_limit.configure(cfg.rate_limits.endpoints)
+    create_scheduler(cfg.scheduler)
+    Executor.result_cache.max_entries = cfg.analytics.memo_size
+    sandbox_pool = create_sandbox_pool(cfg.sandbox)
+
+    videos = list_videos(cfg.batch.videos)
+    questions = read_questions(cfg.batch.questions)
+    logger.info(f"Answering {len(questions)} questions on {len(videos)} videos.")
+    runner = BatchRunner(cfg, questions, sandbox_pool=sandbox_pool)
+    results = runner.run(videos)
+    write_results(results, cfg.batch.output)
+    logger.info(f"Wrote {len(results)} results to {cfg.batch.output}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Early-exit analysis of a video, for questions a single frame can settle."""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextvars
+import logging
+import os
+from pathlib import Path
+import threading
+
+from app import analytics
+from app.pipeline import generate_analytics
+from llm_nim.code_inspection import needs_field
+from utils import fair_scheduler
+
+logger = logging.getLogger(__name__)
+
+
+def bisection_order(count):
+    """Frame indices from coarse to fine: both ends, the middle, the quarters and so on."""
+    if count == 0:
+        return []
+    order = [0] if count == 1 else [0, count - 1]
+    intervals = [(0, count - 1)]
+    while intervals:
+        next_intervals = []
+        for low, high in intervals:
+            if high - low < 2:
+                continue
+            middle = (low + high) // 2
+            order.append(middle)
+            next_intervals += [(low, middle), (middle, high)]
+        intervals = next_intervals
+    return order
+
+
+def sequential_order(count):
+    """Frame indices in temporal order."""
+    return list(range(count))
+
+
+FRAME_ORDERS = {
+    "bisection": bisection_order,
+    "sequential": sequential_order
+}
+
+
+def is_final(result):
+    """Whether a postprocessor output settles the answer for the whole video."""
+    return isinstance(result, dict) and result.get("final") is True
+
+
+def answer_question(frame_ids, frames_dir, noun_chunks, question,
+                    gdino_nim, ocd_nim, gdino_output_path, ocd_output_path, annotations_path,
+                    code_executor, llm_config, cv_config, workers=8, frame_order="bisection", records=False):
+    """Infer and analyze frames until one of them settles the answer.
+
+    The postprocessor is generated on the first frame of ``frame_order``. The
+    other frames are then inferred and analyzed ``workers`` at a time in that
+    order. Once a frame settles the answer the frames that haven't started are
+    cancelled, and the ones in flight stop before their next NIM call. Returns
+    the evaluated frame ids in temporal order, their results and the answer,
+    which is None if no frame settled it.
+    """
+    order = [frame_ids[index] for index in FRAME_ORDERS[frame_order](len(frame_ids))]
+    stop = threading.Event()
+
+    def infer_frame(frame_id, read_text):
+        """Run the CV NIMs on a frame and return its metadata, None once stopped."""
+        image_path = os.path.join(frames_dir, frame_id + ".png")
+        fair_scheduler.run(gdino_nim.infer, image_path, noun_chunks, gdino_output_path)
+        if not read_text:
+            return analytics.parse_frame(frame_id, None, gdino_output_path, annotations_path, records=records)
+        if stop.is_set():
+            return None
+        boxes = gdino_nim.read_boxes(Path(gdino_output_path) / frame_id) if cv_config.ocd_crops else None
+        analytics.load_frame_ocd(ocd_nim, image_path, ocd_output_path, boxes=boxes, padding=cv_config.crop_padding)
+        return analytics.parse_frame(frame_id, ocd_output_path, gdino_output_path, annotations_path, records=records)
+
+    def evaluate(frame_id, read_text):
+        """Analyze a frame. Returns None if it was skipped."""
+        if stop.is_set():
+            return None
+        metadata = infer_frame(frame_id, read_text)
+        if metadata is None or stop.is_set():
+            return None
+        return frame_id, code_executor.execute(metadata)
+
+    metadata = infer_frame(order[0], True)
+    result, code_executor = generate_analytics(
+        metadata, question, code_executor=code_executor, llm_config=llm_config, early_exit=True
+    )
+    results = {order[0]: result}
+    final_result = result if is_final(result) else None
+
+    if final_result is None and len(order) > 1:
+        read_text = cv_config.ocd_mode == "eager" or needs_field(code_executor.source, "object_text")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Each frame runs in a copy of the request's context, so its NIM
+            # requests are queued for the request's session.
+            futures = [
+                executor.submit(contextvars.copy_context().run, evaluate, frame_id, read_text)
+                for frame_id in order[1:]
+            ]
+            try:
+                for future in as_completed(futures):
+                    outcome = future.result()
+                    if outcome is None:
+                        continue
+                    frame_id, result = outcome
+                    results[frame_id] = result
+                    if is_final(result):
+                        final_result = result
+                        break
+            finally:
+                stop.set()
+                for future in futures:
+                    future.cancel()
+
+    evaluated = [frame_id for frame_id in frame_ids if frame_id in results]
+    logger.info(f"Evaluated {len(evaluated)} of {len(frame_ids)} frames: {evaluated}")
+    answer = final_result.get("answer") if final_result is not None else None
+    return evaluated, [results[frame_id] for frame_id in evaluated], answer
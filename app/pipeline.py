@@ -0,0 +1,163 @@
+"""Pipeline stages shared by the gradio apps."""
+
+import logging
+import os
+
+from cv_nim.gdino_nim import DETECTION_CACHE, GDINONIM
+from cv_nim.ocd_nim import OCDNIM
+from llm_nim.openai_nim import InstructionalNIM, NounChunkNIM
+from llm_nim.executor import Executor
+from llm_nim.sandbox import SandboxPool
+from utils import fair_scheduler
+from utils.constants import APP_CACHE, NVCF_API, URL
+from utils.results_store import ResultsStore
+
+NOUN_CHUNK_MODEL = "meta/llama3-70b-instruct"
+CODE_MODEL = "mistralai/codestral-22b-instruct-v0.1"
+
+logger = logging.getLogger(__name__)
+
+
+def create_sandbox_pool(sandbox_config):
+    """Start the sandbox worker pool if it is enabled in the config."""
+    if not sandbox_config.enabled:
+        return None
+    return SandboxPool(
+        workers=sandbox_config.workers,
+        batch_size=sandbox_config.batch_size,
+        wall_time=sandbox_config.wall_time,
+        cpu_time=sandbox_config.cpu_time,
+        memory_mb=sandbox_config.memory_mb,
+        max_calls_per_worker=sandbox_config.max_calls_per_worker
+    )
+
+
+def create_scheduler(scheduler_config):
+    """Start the fair scheduler of the CV and LLM NIM requests if it is enabled in the config."""
+    if not scheduler_config.enabled:
+        return None
+    return fair_scheduler.configure(
+        workers=scheduler_config.workers,
+        quantum=scheduler_config.quantum,
+        urgency=scheduler_config.urgency
+    )
+
+
+def create_results_store(store_config):
+    """Open the store of past answers if it is enabled in the config."""
+    if not store_config.enabled:
+        return None
+    return ResultsStore(
+        store_config.path or os.path.join(APP_CACHE, "results"),
+        max_bytes=store_config.max_size_mb * 1024 * 1024
+    )
+
+
+def create_gdino_nim(cv_config):
+    """Grounding DINO client with the thresholds and cache of the config."""
+    return GDINONIM(
+        NVCF_API,
+        threshold=cv_config.detection_threshold,
+        floor_threshold=cv_config.detection_floor_threshold,
+        cache_dir=DETECTION_CACHE if cv_config.detection_cache else None,
+        cache_max_bytes=cv_config.detection_cache_max_mb * 1024 * 1024,
+        chunk_cache=cv_config.detection_chunk_cache,
+        inline_max_bytes=cv_config.inline_max_bytes
+    )
+
+
+def create_ocd_nim(cv_config):
+    """OCD client with the inline image limit of the config."""
+    return OCDNIM(NVCF_API, inline_max_bytes=cv_config.inline_max_bytes)
+
+
+def extract_noun_chunks(prompt):
+    """Extract noun chunks from user prompt."""
+    noun_chunk_extractor = NounChunkNIM(
+        URL, NVCF_API
+    )
+    base_prompt = noun_chunk_extractor.get_base_prompt()
+    compiled_prompt = f"{base_prompt} Given text: {prompt}"
+    noun_chunk_extractor.assign_model(NOUN_CHUNK_MODEL)
+    data = noun_chunk_extractor.infer(compiled_prompt)
+    return data["noun_chunks"]
+
+
+async def aextract_noun_chunks(prompt):
+    """Extract noun chunks from user prompt on the event loop."""
+    noun_chunk_extractor = NounChunkNIM(
+        URL, NVCF_API
+    )
+    base_prompt = noun_chunk_extractor.get_base_prompt()
+    compiled_prompt = f"{base_prompt} Given text: {prompt}"
+    noun_chunk_extractor.assign_model(NOUN_CHUNK_MODEL)
+    data = await noun_chunk_extractor.ainfer(compiled_prompt)
+    return data["noun_chunks"]
+
+
+def generate_analytics(metadata: dict, question: str, code_executor: Executor, llm_config, early_exit=False):
+    """Run and cache codellama code for each frame.
+
+    The first call requests ``llm_config.num_candidates`` functions in parallel
+    and keeps the first one that runs on this frame's metadata. If none of them
+    does, the error is raised and no further generation is attempted. With
+    ``early_exit`` the generated function may flag that a frame settles the
+    answer for the whole video.
+    """
+    if code_executor.postprocessor:
+        return code_executor.execute(metadata), code_executor
+    if code_executor.failed:
+        raise RuntimeError(f"Code generation already failed:\n{code_executor.error}")
+
+    instructional_nim = InstructionalNIM(
+        URL, NVCF_API
+    )
+    instructional_nim.assign_model(CODE_MODEL)
+    compiled_prompt = instructional_nim.compile_prompt(
+        metadata,
+        question,
+        compact=llm_config.compact_prompt,
+        token_budget=llm_config.prompt_token_budget,
+        max_samples=llm_config.max_prompt_samples,
+        early_exit=early_exit
+    )
+    candidates = instructional_nim.infer_candidates(
+        compiled_prompt,
+        max(1, llm_config.num_candidates),
+        temperature=llm_config.candidate_temperature
+    )
+    result = code_executor.synthesize(
+        candidates, metadata, timeout=llm_config.validation_timeout
+    )
+    return result, code_executor
+
+
+def generate_video_analytics(video: dict, question: str, code_executor: Executor, llm_config):
+    """Generate and run one postprocessor over the columnar detections of a video.
+
+    Returns the per-frame annotations and the answer for the whole video.
+    """
+    if code_executor.postprocessor:
+        return code_executor.execute_video(video), code_executor
+    if code_executor.failed:
+        raise RuntimeError(f"Code generation already failed:\n{code_executor.error}")
+
+    instructional_nim = InstructionalNIM(
+        URL, NVCF_API
+    )
+    instructional_nim.assign_model(CODE_MODEL)
+    compiled_prompt = instructional_nim.compile_video_prompt(
+        video,
+        question,
+        token_budget=llm_config.prompt_token_budget,
+        max_samples=llm_config.max_prompt_samples
+    )
+    candidates = instructional_nim.infer_candidates(
+        compiled_prompt,
+        max(1, llm_config.num_candidates),
+        temperature=llm_config.candidate_temperature
+    )
+    result = code_executor.synthesize(
+        candidates, video, timeout=llm_config.validation_timeout, check=Executor.check_video_result
+    )
+    return Executor.split_video_result(result, video["frame_ids"]), code_executor
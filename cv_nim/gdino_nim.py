@@ -7,21 +7,79 @@ import zipfile
 import time
 import requests
 from pathlib import Path
-from PIL import Image 
 from tqdm import tqdm 
 from concurrent.futures import ThreadPoolExecutor, as_completed 
 import traceback
+
+from utils import fair_scheduler, rate_limit
+from utils.file_cache import get_file_cache
+from utils.result_cache import ResultCache
+from utils.singleflight import SingleFlight, fingerprint
+from utils.constants import APP_CACHE
+from utils.utils import encode_jpeg, inline_image
+
 nvai_polling_url = "https://api.nvcf.nvidia.com/v2/nvcf/pexec/status/"
 MAX_RETRIES = 5 # Max num of retries while polling
 DELAY_BTW_RETRIES = 1 # adding 1s delay between each polls
+DETECTION_CACHE = os.path.join(APP_CACHE, "gdino")
+
+
+def clean_phrase(phrase):
+    """Class name of a Grounding DINO phrase."""
+    return phrase.strip("[]").replace("'", "").strip()
+
+
+def split_prompt(prompt):
+    """Noun chunks of a comma separated prompt, without duplicates."""
+    return list(dict.fromkeys(chunk.strip() for chunk in prompt.split(",") if chunk.strip()))
+
+
+def phrase_chunk(phrase, chunks):
+    """Noun chunk a detected phrase comes from: the same text, else the one sharing most words.
+
+    Returns None if the phrase shares no word with any of the chunks.
+    """
+    phrase = clean_phrase(phrase).lower()
+    for chunk in chunks:
+        if chunk.lower() == phrase:
+            return chunk
+    words = set(phrase.split())
+    best = max(chunks, key=lambda chunk: len(words & set(chunk.lower().split())), default=None)
+    if best is None or not words & set(best.lower().split()):
+        return None
+    return best
 
 class GDINONIM:
 
-    def __init__(self, api_key, url="https://ai.api.nvidia.com/v1/cv/nvidia/nv-grounding-dino"):
+    # Identical requests from concurrent sessions share one upstream call.
+    _inflight = SingleFlight()
+    # Detections per frame and noun chunk, shared by all sessions.
+    _chunk_cache = ResultCache(max_entries=65536)
+
+    def __init__(self, api_key, url="https://ai.api.nvidia.com/v1/cv/nvidia/nv-grounding-dino",
+                 threshold=0.3, floor_threshold=None, cache_dir=None, cache_max_bytes=1 << 30, chunk_cache=False,
+                 inline_max_bytes=180000):
+        """Constructor.
 
+        Grounding DINO is queried at ``floor_threshold`` and the detections
+        under ``threshold`` are dropped locally, so responses stay reusable
+        across thresholds. With a ``cache_dir`` the raw responses are kept
+        there and identical queries don't reach the NIM again, evicting the
+        least recently used ones past ``cache_max_bytes``. With
+        ``chunk_cache`` detections are kept per frame and noun chunk, and a
+        prompt only queries the noun chunks that weren't seen on the frame.
+        Images whose base64 encoding fits in ``inline_max_bytes`` are sent
+        inline with the inference request, larger ones as NVCF assets.
+        """
         self.api_key = api_key 
         self.url = url 
         self.header_auth = f"Bearer {self.api_key}"
+        self.threshold = threshold
+        self.floor_threshold = threshold if floor_threshold is None else min(floor_threshold, threshold)
+        self.cache_dir = cache_dir
+        self.disk_cache = get_file_cache(cache_dir, cache_max_bytes) if cache_dir is not None else None
+        self.chunk_cache = chunk_cache
+        self.inline_max_bytes = inline_max_bytes
 
     def _upload_asset(self, input, description):
         assets_url = "https://api.nvcf.nvidia.com/v2/nvcf/assets"
@@ -39,26 +97,18 @@ class GDINONIM:
 
         payload = {"contentType": "image/jpeg", "description": description}
 
-        response = requests.post(assets_url, headers=headers, json=payload, timeout=300)
+        response = rate_limit.limiter("nvcf_assets").request(
+            "POST", assets_url, headers=headers, json=payload, timeout=300
+        )
         response.raise_for_status()
 
         asset_url = response.json()["uploadUrl"]
         asset_id = response.json()["assetId"]
 
-        # Convert image to jpeg before uploading 
-        try:
-            image = Image.open(str(input)).convert("RGB")
-            buf = io.BytesIO() #temporary buffer to save image
-            image.save(buf, format="JPEG")
-        except Exception as e:
-            print("An error occurred:")
-            print(e)
-            print(traceback.format_exc())
-
         try:
             response = requests.put(
                 asset_url,
-                data=buf.getvalue(),
+                data=encode_jpeg(input),
                 headers=s3_headers,
                 timeout=300,
             )
@@ -66,17 +116,25 @@ class GDINONIM:
             print("An error occurred:")
             print(e)
             print(traceback.format_exc())
+            raise
 
         response.raise_for_status()
         return uuid.UUID(asset_id)
 
-    def infer(self, image_path, prompt, output_folder=None):
-        if output_folder:
-            os.makedirs(output_folder, exist_ok=True)
-
-        asset_id = self._upload_asset(image_path, "Input Image")
+    def _post_inference(self, image_path, prompt):
+        """Send the image inline or as an asset and run inference. Returns the zipped response."""
+        image_bytes = encode_jpeg(image_path)
+        data_url = inline_image(image_bytes, self.inline_max_bytes)
+        headers = {
+                    "Content-Type": "application/json",
+                    "Authorization": self.header_auth,
+                }
+        if data_url is None:
+            asset_id = self._upload_asset(image_bytes, "Input Image")
+            data_url = f"data:image/jpeg;asset_id,{asset_id}"
+            headers["NVCF-INPUT-ASSET-REFERENCES"] = f"{asset_id}"
+            headers["NVCF-FUNCTION-ASSET-IDS"] = f"{asset_id}"
 
-        inputs = {"image": f"{asset_id}", "render_label": False}
         inputs = { "model": "Grounding-Dino",
                     "messages": [
                     {
@@ -89,62 +147,165 @@ class GDINONIM:
                             {
                             "type": "media_url",
                             "media_url": {
-                            "url": f"data:image/jpeg;asset_id,{asset_id}"
+                            "url": data_url
                             }
                         }
                         ]
                     }
                     ],
-                    "threshold": 0.3
+                    "threshold": self.floor_threshold
                 }
-        asset_list = f"{asset_id}"
 
-        headers = {
-                    "Content-Type": "application/json",
-                    "NVCF-INPUT-ASSET-REFERENCES": asset_list,
-                    "NVCF-FUNCTION-ASSET-IDS": asset_list,
-                    "Authorization": self.header_auth,
-                }
+        gdino_limiter = rate_limit.limiter("gdino")
+        response = gdino_limiter.request("POST", self.url, headers=headers, json=inputs)
+        if response.status_code == 202: # pending evaluation
+            print("Pending evaluation ...")
+            polling_url = nvai_polling_url + response.headers['NVCF-REQID']
+            headers_polling = { "accept": "application/json", "Authorization": self.header_auth }
+
+            # Polling to check if the response is ready
+            for _ in range(MAX_RETRIES):
+                print(f'Polling ...')
+                response = gdino_limiter.request("GET", polling_url, headers=headers_polling)
+                if response.status_code != 202: # evaluation complete or failed
+                    break
+                print('Result is not yet ready.')
+                time.sleep(DELAY_BTW_RETRIES)
+            else:
+                raise TimeoutError(f"Grounding DINO result not ready after {MAX_RETRIES} polls.")
+
+        response.raise_for_status()
+        return response.content
+
+    def _cached_inference(self, request_key, image, prompt):
+        """Raw zipped response of a query, from the cache if it was already made."""
+        if self.disk_cache is None:
+            return self._post_inference(image, prompt)
+        content = self.disk_cache.get(request_key + ".zip")
+        if content is not None:
+            return content
+        content = self._post_inference(image, prompt)
+        self.disk_cache.put(request_key + ".zip", content)
+        return content
+
+    def _get_chunk(self, chunk_key):
+        """Cached bounding boxes of a noun chunk on a frame, None on a miss."""
+        found, boxes = self._chunk_cache.get(chunk_key)
+        if found:
+            return boxes
+        if self.disk_cache is not None:
+            content = self.disk_cache.get(os.path.join("chunks", chunk_key + ".json"))
+            if content is not None:
+                boxes = json.loads(content)
+                self._chunk_cache.put(chunk_key, boxes)
+                return boxes
+        return None
+
+    def _put_chunk(self, chunk_key, boxes):
+        """Cache the bounding boxes of a noun chunk on a frame."""
+        self._chunk_cache.put(chunk_key, boxes)
+        if self.disk_cache is not None:
+            self.disk_cache.put(os.path.join("chunks", chunk_key + ".json"), json.dumps(boxes).encode("utf-8"))
+
+    def _query_chunks(self, image, image_bytes, prompt):
+        """Response of Grounding DINO at the floor threshold, queried per missing noun chunk.
+
+        The noun chunks not cached for the frame are sent in one prompt, and
+        the detections of the response are attributed to them by phrase.
+        """
+        chunks = split_prompt(prompt)
+        image_key = fingerprint(image_bytes)
+        chunk_keys = {
+            chunk: fingerprint(self.url, image_key, chunk.lower(), self.floor_threshold) for chunk in chunks
+        }
+        chunk_boxes = {chunk: self._get_chunk(chunk_keys[chunk]) for chunk in chunks}
+        missing = [chunk for chunk in chunks if chunk_boxes[chunk] is None]
+        if missing:
+            data = self._read_response(self._query(image, image_bytes, ",".join(missing)))
+            for chunk in missing:
+                chunk_boxes[chunk] = []
+            for choice in data["choices"]:
+                for box in choice["message"]["content"]["boundingBoxes"]:
+                    chunk = phrase_chunk(box["phrase"], missing)
+                    # A phrase that can't be told apart would be cached under
+                    # the wrong chunk for good, so it is dropped.
+                    if chunk is not None:
+                        chunk_boxes[chunk].append(box)
+            for chunk in missing:
+                self._put_chunk(chunk_keys[chunk], chunk_boxes[chunk])
+        return {"choices": [{"index": 0, "message": {"role": "assistant", "content": {
+            "frameNo": 0,
+            "boundingBoxes": [box for chunk in chunks for box in chunk_boxes[chunk]]
+        }}}]}
+
+    def _query(self, image, image_bytes, prompt):
+        """Raw zipped response of Grounding DINO at the floor threshold."""
+        request_key = fingerprint(self.url, image_bytes, prompt, self.floor_threshold)
+        return self._inflight.do(request_key, self._cached_inference, request_key, image, prompt)
+
+    def filter_response(self, data, threshold=None):
+        """Copy of a response without the detections under ``threshold``, the instance's by default."""
+        threshold = self.threshold if threshold is None else threshold
+        if threshold <= self.floor_threshold:
+            return data
+        data = dict(data, choices=[dict(choice, message=dict(choice["message"])) for choice in data["choices"]])
+        for choice in data["choices"]:
+            content = dict(choice["message"]["content"])
+            bounding_boxes = []
+            for box in content["boundingBoxes"]:
+                kept = [
+                    (bbox, confidence) for bbox, confidence in zip(box["bboxes"], box["confidence"])
+                    if confidence >= threshold
+                ]
+                bounding_boxes.append(dict(
+                    box, bboxes=[bbox for bbox, _ in kept], confidence=[confidence for _, confidence in kept]
+                ))
+            content["boundingBoxes"] = bounding_boxes
+            choice["message"]["content"] = content
+        return data
+
+    def infer(self, image_path, prompt, output_folder=None):
+        if output_folder:
+            os.makedirs(output_folder, exist_ok=True)
+
+        if self.chunk_cache:
+            data = self.filter_response(self._query_chunks(image_path, Path(image_path).read_bytes(), prompt))
+            results_dir = Path(output_folder or Path(image_path).parent) / Path(image_path).stem
+            os.makedirs(results_dir, exist_ok=True)
+            (results_dir / (Path(image_path).stem + ".response")).write_text(json.dumps(data))
+            return
+
+        content = self._query(image_path, Path(image_path).read_bytes(), prompt)
 
-        response = requests.post(self.url, headers=headers, json=inputs)
         if output_folder:
             zip_path = Path(output_folder) / (Path(image_path).stem + ".zip")
         else:
             zip_path = Path(image_path).with_suffix(".zip")
 
-        if response.status_code == 200: # evaluation complete, output video ready
-            with open(zip_path, "wb") as out:
-                out.write(response.content)
-            with zipfile.ZipFile(zip_path, "r") as z:
-                z.extractall(zip_path.parent/zip_path.stem)
+        with open(zip_path, "wb") as out:
+            out.write(content)
+        with zipfile.ZipFile(zip_path, "r") as z:
+            z.extractall(zip_path.parent/zip_path.stem)
 
-        elif response.status_code == 202: # pending evaluation
-            print("Pending evaluation ...")
-            nvcf_reqid = response.headers['NVCF-REQID']
-            nvai_polling_url = nvai_polling_url + nvcf_reqid
+        zip_path.unlink() #delete temp zip 
 
-            # Polling to check if the response is ready
-            while( MAX_RETRIES ):
-                print(f'Polling ...')
-                headers_polling = { "accept": "application/json", "Authorization": header_auth }
-                response_polling = requests.get(nvai_polling_url, headers=headers_polling)
-                if response_polling.status_code == 202: # evaluation pending
-                    print('Result is not yet ready.')
-                    MAX_RETRIES -= 1
-                    time.sleep(DELAY_BTW_RETRIES)
-                    continue
-                elif response_polling.status_code == 200: # evaluation complete, output video ready
-                    print('Result ready!')
-                    with open(zip_path, "wb") as out:
-                        out.write(response_polling.content)
-                    break
-                else:
-                    print(f"Unexpected response status: {response_polling.status_code}")
+        if self.threshold > self.floor_threshold:
+            # Readers of the extracted response only see detections above the threshold.
+            response_file = next((zip_path.parent/zip_path.stem).glob('*.response'))
+            data = self.filter_response(json.loads(response_file.read_text()))
+            response_file.write_text(json.dumps(data))
 
-            with zipfile.ZipFile(zip_path, "r") as z:
-                z.extractall(zip_path.parent/zip_path.stem)
+    def _read_response(self, content):
+        """Load the JSON response out of a zipped inference result."""
+        with zipfile.ZipFile(io.BytesIO(content), "r") as z:
+            name = next(name for name in z.namelist() if name.endswith(".response"))
+            return json.loads(z.read(name))
 
-        zip_path.unlink() #delete temp zip 
+    def infer_bytes(self, image_bytes, prompt):
+        """Run inference on an encoded image held in memory and return the parsed response."""
+        if self.chunk_cache:
+            return self.filter_response(self._query_chunks(image_bytes, image_bytes, prompt))
+        return self.filter_response(self._read_response(self._query(image_bytes, image_bytes, prompt)))
 
     def batch_infer(self, input_folder, prompt, output_folder, workers=16):
         input_folder = Path(input_folder)
@@ -154,14 +315,18 @@ class GDINONIM:
             if image_path.suffix  in ['.png', '.jpeg', '.jpg']:
                 image_files.append(image_path)
 
+        # Requests go through the shared fair scheduler when it is running.
+        scheduler = fair_scheduler.get_scheduler()
         with ThreadPoolExecutor(max_workers = workers) as executor: 
-            futures = [executor.submit(self.infer, image_path.resolve(), prompt, output_folder) for image_path in image_files]
+            submit = executor.submit if scheduler is None else scheduler.submit
+            futures = [submit(self.infer, image_path.resolve(), prompt, output_folder) for image_path in image_files]
             #Wait for all jobs to complete. 
             for future in tqdm(as_completed(futures), total=len(futures)):
                 pass
 
-    def write_output_as_kitti_file(self, data, output_file_path):
+    def write_output_as_kitti_file(self, data, output_file_path, threshold=None):
         # Process the bounding boxes and write to KITTI format
+        data = self.filter_response(data, threshold)
         with open(output_file_path, 'w') as file:
             for choice in data["choices"]:
                 message_content = choice["message"]["content"]
@@ -169,7 +334,7 @@ class GDINONIM:
                 
                 # Iterate through each bounding box
                 for box in message_content["boundingBoxes"]:
-                    phrase = box["phrase"].strip("[]").replace("'", "").strip()  # Clean up phrase
+                    phrase = clean_phrase(box["phrase"])  # Clean up phrase
                     for bbox, confidence in zip(box["bboxes"], box["confidence"]):
                         # KITTI format: Class, 0, 0, 0, xmin, ymin, xmax, ymax, 0, 0, 0, 0, 0, 0, 0, confidence
                         xmin, ymin, xmax, ymax = bbox
@@ -179,9 +344,30 @@ class GDINONIM:
         print(f"Bounding boxes have been written to {output_file_path} in KITTI format.")
 
 
-    def parse_output(self, results_path, sort=True):
-        ocd_response_file = list(Path(results_path).glob('*.response'))[0] #get response file 
-        with ocd_response_file.open('r') as file:
-            data = json.load(file)
+    def _load_response(self, results_path):
+        response_file = list(Path(results_path).glob('*.response'))[0] #get response file 
+        with response_file.open('r') as file:
+            return json.load(file)
+
+    def parse_detections(self, data, threshold=None):
+        """Class name, box and confidence of every detection in a response, in the order of the KITTI file."""
+        detections = []
+        for choice in self.filter_response(data, threshold)["choices"]:
+            for box in choice["message"]["content"]["boundingBoxes"]:
+                phrase = clean_phrase(box["phrase"])
+                for bbox, confidence in zip(box["bboxes"], box["confidence"]):
+                    detections.append((phrase, bbox, confidence))
+        return detections
+
+    def read_detections(self, results_path, threshold=None):
+        """Class name and box of every detection, in the order of the KITTI file."""
+        data = self._load_response(results_path)
+        return [(phrase, bbox) for phrase, bbox, _ in self.parse_detections(data, threshold)]
+
+    def read_boxes(self, results_path, threshold=None):
+        """Boxes of every detection in an inference result."""
+        return [bbox for _, bbox in self.read_detections(results_path, threshold)]
 
-            self.write_output_as_kitti_file(data, f"{results_path}/labels.txt")
+    def parse_output(self, results_path, sort=True, output_file=None, threshold=None):
+        data = self._load_response(results_path)
+        self.write_output_as_kitti_file(data, output_file or f"{results_path}/labels.txt", threshold)
@@ -12,18 +12,33 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 
+from utils.mosaic import build_mosaic, map_polygon_to_frame
+from utils import fair_scheduler, rate_limit
+from utils.records import TextRegion
+from utils.singleflight import SingleFlight, fingerprint
+from utils.utils import encode_jpeg, inline_image
+
 class OCDNIM:
 
-    def __init__(self, api_key, url="https://ai.api.nvidia.com/v1/cv/nvidia/ocdrnet"):
+    # Identical requests from concurrent sessions share one upstream call.
+    _inflight = SingleFlight()
+
+    def __init__(self, api_key, url="https://ai.api.nvidia.com/v1/cv/nvidia/ocdrnet", inline_max_bytes=180000):
+        """Constructor.
+
+        Images whose base64 encoding fits in ``inline_max_bytes`` are sent
+        inline with the inference request, larger ones as NVCF assets.
+        """
 
         self.api_key = api_key 
         self.url = url 
         self.header_auth = f"Bearer {self.api_key}"
+        self.inline_max_bytes = inline_max_bytes
 
-    def _upload_asset(self, image_path, description):
+    def _upload_asset(self, image, description):
         """
         Uploads an asset to the NVCF API.
-        :param image_path: The image path 
+        :param image: The image path, a PIL image or encoded image bytes
         :param description: A description of the asset
 
         """
@@ -43,22 +58,19 @@ class OCDNIM:
 
         payload = {"contentType": f"image/jpeg", "description": description}
 
-        response = requests.post(assets_url, headers=headers, json=payload, timeout=30)
+        response = rate_limit.limiter("nvcf_assets").request(
+            "POST", assets_url, headers=headers, json=payload, timeout=30
+        )
 
         response.raise_for_status()
 
         asset_url = response.json()["uploadUrl"]
         asset_id = response.json()["assetId"]
 
-        #Convert image to jpeg before uploading 
-        image = Image.open(image_path).convert("RGB")
-        buf = io.BytesIO() #temporary buffer to save image
-        image.save(buf, format="JPEG")
-
-        #upload image 
+        #upload image as jpeg 
         response = requests.put(
             asset_url,
-            data=buf.getvalue(),
+            data=encode_jpeg(image),
             headers=s3_headers,
             timeout=300,
         )
@@ -66,23 +78,40 @@ class OCDNIM:
         response.raise_for_status()
         return uuid.UUID(asset_id)
 
-    def infer(self, image_path, output_folder=None):
-        if output_folder:
-            os.makedirs(output_folder, exist_ok=True)
+    def _post_inference(self, image):
+        """Send the image inline or as an asset and run inference. Returns the zipped response."""
+        image_bytes = encode_jpeg(image)
+        data_url = inline_image(image_bytes, self.inline_max_bytes)
+        if data_url is not None:
+            # Small images skip the asset registration and upload round trips.
+            inputs = {"image": data_url, "render_label": False}
+            headers = {
+            "Content-Type": "application/json",
+            "Authorization": self.header_auth,
+            }
+        else:
+            asset_id = self._upload_asset(image_bytes, "Input Image")
 
-        asset_id = self._upload_asset(image_path, "Input Image")
+            inputs = {"image": f"{asset_id}", "render_label": False}
+            asset_list = f"{asset_id}"
 
-        inputs = {"image": f"{asset_id}", "render_label": False}
-        asset_list = f"{asset_id}"
+            headers = {
+            "Content-Type": "application/json",
+            "NVCF-INPUT-ASSET-REFERENCES": asset_list,
+            "NVCF-FUNCTION-ASSET-IDS": asset_list,
+            "Authorization": self.header_auth,
+            }
 
-        headers = {
-        "Content-Type": "application/json",
-        "NVCF-INPUT-ASSET-REFERENCES": asset_list,
-        "NVCF-FUNCTION-ASSET-IDS": asset_list,
-        "Authorization": self.header_auth,
-        }
+        response = rate_limit.limiter("ocd").request("POST", self.url, headers=headers, json=inputs)
+        response.raise_for_status()
+        return response.content
+
+    def infer(self, image_path, output_folder=None):
+        if output_folder:
+            os.makedirs(output_folder, exist_ok=True)
 
-        response = requests.post(self.url, headers=headers, json=inputs)
+        request_key = fingerprint(self.url, Path(image_path).read_bytes())
+        content = self._inflight.do(request_key, self._post_inference, image_path)
 
         if output_folder:
             zip_path = Path(output_folder) / (Path(image_path).stem + ".zip")
@@ -90,23 +119,87 @@ class OCDNIM:
             zip_path = Path(image_path).with_suffix(".zip")
 
         with open(zip_path, "wb") as out:
-            out.write(response.content)
+            out.write(content)
 
         with zipfile.ZipFile(zip_path, "r") as z:
             z.extractall(zip_path.parent/zip_path.stem)
         
         zip_path.unlink() #delete temp zip 
    
-    def batch_infer(self, input_folder, output_folder, workers=16):
+    def _read_response(self, content):
+        """Load the JSON response out of a zipped inference result."""
+        with zipfile.ZipFile(io.BytesIO(content), "r") as z:
+            name = next(name for name in z.namelist() if name.endswith(".response"))
+            return json.loads(z.read(name))
+
+    def _write_response(self, data, image_path, output_folder):
+        """Write a response where parse_output expects the frame's results."""
+        results_path = Path(output_folder) / Path(image_path).stem
+        os.makedirs(results_path, exist_ok=True)
+        with open(results_path / (Path(image_path).stem + ".response"), "w") as out:
+            json.dump(data, out)
+
+    def infer_crops(self, image_path, boxes, output_folder, padding=16):
+        """Run OCD on the detected regions of a frame only.
+
+        The padded boxes are packed into a mosaic, and the polygons found on
+        it are mapped back to frame coordinates. Frames without boxes get an
+        empty result without calling the NIM, and frames whose boxes cover
+        most of the image are sent whole.
+        """
+        if not boxes:
+            self._write_response({"metadata": []}, image_path, output_folder)
+            return
+
+        packed = build_mosaic(Image.open(image_path).convert("RGB"), boxes, padding)
+        if packed is None:
+            self.infer(image_path, output_folder)
+            return
+        mosaic, tiles = packed
+        mosaic_bytes = encode_jpeg(mosaic)
+        content = self._inflight.do(fingerprint(self.url, mosaic_bytes), self._post_inference, mosaic_bytes)
+
+        data = self._read_response(content)
+        metadata = []
+        for entry in data.get("metadata", []):
+            polygon = map_polygon_to_frame(entry["polygon"], tiles)
+            if polygon is not None:
+                metadata.append({**entry, "polygon": polygon})
+        data["metadata"] = metadata
+        self._write_response(data, image_path, output_folder)
+
+    def infer_bytes(self, image_bytes):
+        """Run OCD on an encoded image held in memory and return the parsed response."""
+        content = self._inflight.do(fingerprint(self.url, image_bytes), self._post_inference, image_bytes)
+        return self._read_response(content)
+
+    def batch_infer(self, input_folder, output_folder, workers=16, skip_existing=False, boxes=None, padding=16):
+        """Run OCD on every image of a folder.
+
+        With ``boxes``, a mapping from image name to its detected boxes, only
+        the detected regions are sent to OCD. Requests go through the shared
+        fair scheduler when it is running, else through ``workers`` threads.
+        """
         input_folder = Path(input_folder)
 
         image_files = []
         for image_path in input_folder.iterdir():
             if image_path.suffix  in ['.png', '.jpeg', '.jpg']:
+                # Frames that already have OCD results don't need to run again.
+                if skip_existing and (Path(output_folder) / image_path.stem).exists():
+                    continue
                 image_files.append(image_path)
 
+        scheduler = fair_scheduler.get_scheduler()
         with ThreadPoolExecutor(max_workers = workers) as executor: 
-            futures = [executor.submit(self.infer, image_path.resolve(), output_folder) for image_path in image_files]
+            submit = executor.submit if scheduler is None else scheduler.submit
+            if boxes is None:
+                futures = [submit(self.infer, image_path.resolve(), output_folder) for image_path in image_files]
+            else:
+                futures = [
+                    submit(self.infer_crops, image_path.resolve(), boxes.get(image_path.stem, []), output_folder, padding)
+                    for image_path in image_files
+                ]
             #Wait for all jobs to complete. 
             logging.info("OCD Inference")
             for future in tqdm(as_completed(futures), total=len(futures)):
@@ -121,11 +214,13 @@ class OCDNIM:
         return centroid_x, centroid_y
 
 
-    def parse_output(self, results_path, sort=True):
+    def parse_output(self, results_path, sort=True, records=False):
         ocd_response_file = list(Path(results_path).glob('*.response'))[0] #get response file 
         with ocd_response_file.open('r') as file:
             data = json.load(file)
+        return self.parse_response(data, sort=sort, records=records)
 
+    def parse_response(self, data, sort=True, records=False):
         if sort:
             """Sort the results based on the polygons from topleft to bottoms right."""
             for entry in data["metadata"]: #calculate centroid for each polygon 
@@ -137,4 +232,7 @@ class OCDNIM:
             for entry in data['metadata']: #remove centroid 
                 del entry['centroid']
 
+        if records: #compact text regions 
+            data['metadata'] = [TextRegion.from_ocd(entry) for entry in data['metadata']]
+
         return data 
@@ -2,10 +2,12 @@
 
 from .openai_nim import InstructionalNIM, NounChunkNIM, OpenAINIM
 from .executor import Executor
+from .metrics import llm_metrics
 
 __all__ = [
     "InstructionalNIM",
     "NounChunkNIM",
     "OpenAINIM",
-    "Executor"
+    "Executor",
+    "llm_metrics"
 ]
@@ -0,0 +1,258 @@
+# Copyright (c) 2024, NVIDIA CORPORATION.  All rights reserved.
+
+"""Static inspection of generated postprocessors."""
+
+import ast
+
+# Calls through which a function can reach every field of a detection.
+DYNAMIC_ACCESS_CALLS = ("items", "values", "keys", "dumps", "vars")
+# Calls that read every field of a detection passed to them.
+SERIALIZING_CALLS = (
+    "dict", "str", "repr", "list", "tuple", "set", "print", "format", "copy", "deepcopy", "sorted"
+)
+# Calls that read every field of the detections of a list passed to them.
+LIST_SERIALIZING_CALLS = ("str", "repr", "print", "format", "deepcopy")
+# Calls building containers of the generated code's own, or lists of detections.
+CONTAINER_CALLS = (
+    "dict", "list", "set", "tuple", "sorted", "reversed", "filter", "defaultdict", "Counter", "OrderedDict"
+)
+# Calls whose items are those of their iterable arguments.
+ITERATION_CALLS = ("enumerate", "zip", "sorted", "reversed", "filter", "list", "tuple", "set")
+# Calls returning one of the detections of a list.
+PICKING_CALLS = ("max", "min", "next")
+# Calls known not to reach the fields of the detections passed to them,
+# other than through the checks above.
+KNOWN_CALLS = CONTAINER_CALLS + ITERATION_CALLS + PICKING_CALLS + (
+    "len", "sum", "any", "all", "abs", "round", "int", "float", "bool", "range", "isinstance", "iter",
+    "append", "extend", "add", "insert", "index", "count", "remove", "sort", "get", "pop", "setdefault"
+)
+# Methods of the lists of detections and of the containers built by the code.
+CONTAINER_METHODS = (
+    "append", "extend", "add", "insert", "index", "count", "remove", "sort", "get", "pop", "setdefault",
+    "update", "clear"
+)
+CONTAINER_NODES = (
+    ast.List, ast.ListComp, ast.Dict, ast.DictComp, ast.Set, ast.SetComp, ast.Tuple, ast.GeneratorExp
+)
+
+
+def _call_name(node):
+    """Name of the function a call node calls."""
+    function = node.func
+    return function.attr if isinstance(function, ast.Attribute) else getattr(function, "id", None)
+
+
+def _is_field_read(node):
+    """Whether a node reads a field with a constant key, ``detection["bbox"]``."""
+    return isinstance(node, ast.Subscript) and \
+        isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str)
+
+
+def _target_names(target):
+    """Names bound by an assignment or loop target."""
+    return {node.id for node in ast.walk(target) if isinstance(node, ast.Name)}
+
+
+class _Names:
+    """What the names of a generated function may hold.
+
+    ``containers`` hold lists of detections or containers built by the code,
+    ``values`` hold field values, and ``detections`` may hold a detection.
+    A name that may hold a detection is never trusted as anything else.
+    """
+
+    def __init__(self, tree, function_name):
+        """Classify the names bound in a parsed function."""
+        self.containers = set()
+        self.values = set()
+        self.detections = set()
+        self.functions = set()  # functions defined by the code
+        for node in tree.body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == function_name:
+                # The metadata of a frame is a list of detections.
+                self.containers.update(argument.arg for argument in node.args.args[:1])
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                self.functions.add(node.name)
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+                arguments = node.args.posonlyargs + node.args.args + node.args.kwonlyargs
+                # Helpers and key functions may be handed a detection.
+                self.detections.update(
+                    argument.arg for argument in arguments if argument.arg not in self.containers
+                )
+            elif isinstance(node, (ast.Assign, ast.AnnAssign)) and node.value is not None:
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                for target in targets:
+                    self._bind(target, node.value)
+            elif isinstance(node, ast.For):
+                self._bind_loop(node.target, node.iter)
+            elif isinstance(node, ast.comprehension):
+                self._bind_loop(node.target, node.iter)
+        self.containers -= self.detections
+        self.values -= self.detections
+
+    def _bind(self, target, value):
+        """Classify the names assigned ``value``."""
+        if isinstance(target, (ast.Tuple, ast.List, ast.Starred)):
+            # Unpacked items may be anything, such as the detections of a list.
+            if not _is_field_read(value):
+                self.detections.update(_target_names(target))
+            return
+        if not isinstance(target, ast.Name):
+            # Item and attribute assignments don't bind names.
+            return
+        if isinstance(value, CONTAINER_NODES) or \
+                (isinstance(value, ast.Call) and _call_name(value) in CONTAINER_CALLS) or \
+                (isinstance(value, ast.Subscript) and isinstance(value.slice, ast.Slice)):
+            self.containers.add(target.id)
+        elif _is_field_read(value) or isinstance(value, (ast.Constant, ast.BinOp, ast.JoinedStr)):
+            self.values.add(target.id)
+        elif isinstance(value, ast.Subscript) or \
+                (isinstance(value, ast.Call) and _call_name(value) in PICKING_CALLS) or \
+                (isinstance(value, ast.Name) and value.id in self.detections):
+            self.detections.add(target.id)
+        elif isinstance(value, ast.Name) and value.id in self.containers:
+            self.containers.add(target.id)
+
+    def _bind_loop(self, target, iterable):
+        """Classify the names bound by iterating over ``iterable``."""
+        if isinstance(iterable, ast.Call) and _call_name(iterable) == "range":
+            self.values.update(_target_names(target))
+        elif isinstance(iterable, ast.Call) and _call_name(iterable) == "enumerate" and \
+                isinstance(target, ast.Tuple) and len(target.elts) == 2:
+            self.values.update(_target_names(target.elts[0]))
+            self.detections.update(_target_names(target.elts[1]))
+        else:
+            self.detections.update(_target_names(target))
+
+    def is_detection(self, node):
+        """Whether a node may hold a detection."""
+        return isinstance(node, ast.Name) and node.id in self.detections
+
+    def is_container(self, node):
+        """Whether a node holds a list of detections or a container built by the code."""
+        return isinstance(node, ast.Name) and node.id in self.containers
+
+    def carries(self, node):
+        """Whether the value of an expression may hold or contain a detection."""
+        if isinstance(node, ast.Name):
+            return node.id in self.detections or node.id in self.containers
+        if _is_field_read(node) or isinstance(node, ast.Constant):
+            return False
+        if isinstance(node, ast.Subscript):
+            return self.carries(node.value)
+        if isinstance(node, (ast.ListComp, ast.SetComp, ast.GeneratorExp)):
+            return self.carries(node.elt)
+        if isinstance(node, ast.DictComp):
+            return self.carries(node.key) or self.carries(node.value)
+        if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+            return any(self.carries(element) for element in node.elts)
+        if isinstance(node, ast.Dict):
+            return any(self.carries(item) for item in node.keys + node.values if item is not None)
+        if isinstance(node, ast.IfExp):
+            return self.carries(node.body) or self.carries(node.orelse)
+        if isinstance(node, ast.BoolOp):
+            return any(self.carries(value) for value in node.values)
+        if isinstance(node, (ast.NamedExpr, ast.Starred)):
+            return self.carries(node.value)
+        if isinstance(node, ast.Call):
+            return _call_name(node) in CONTAINER_CALLS + ITERATION_CALLS + PICKING_CALLS + ("iter",) and \
+                any(self.carries(argument) for argument in node.args)
+        return False
+
+    def can_index(self, node):
+        """Whether a node may be subscripted with a computed key without reading a detection."""
+        return self.is_container(node) or _is_field_read(node) or \
+            (isinstance(node, ast.Name) and node.id in self.values)
+
+    def can_iterate(self, node):
+        """Whether iterating over a node never iterates over a detection."""
+        if isinstance(node, CONTAINER_NODES) or _is_field_read(node) or self.can_index(node):
+            return True
+        if isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Slice):
+            return self.can_iterate(node.value)
+        if isinstance(node, ast.Call):
+            name = _call_name(node)
+            if name == "range":
+                return True
+            if name in ITERATION_CALLS:
+                return all(
+                    isinstance(argument, ast.Lambda) or self.can_iterate(argument)
+                    for argument in node.args
+                )
+        return False
+
+
+def required_fields(function_string, function_name="postprocessor"):
+    """Metadata fields a generated function reads.
+
+    Fields are collected from constant subscripts (``detection["bbox"]``),
+    ``get``/``pop``/``setdefault`` calls and ``"field" in detection`` tests.
+    Returns None unless every access to a detection reads a constant key, for
+    example when the function computes keys, iterates over a detection,
+    copies or serializes detections, calls ``detection.items()``, returns
+    detections or hands them to code it doesn't define.
+    """
+    tree = ast.parse(function_string)
+    names = _Names(tree, function_name)
+    fields = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Subscript):
+            if _is_field_read(node):
+                fields.add(node.slice.value)
+            elif not isinstance(node.slice, (ast.Constant, ast.Slice)) and not names.can_index(node.value):
+                return None
+        elif isinstance(node, ast.Call):
+            name = _call_name(node)
+            if name in DYNAMIC_ACCESS_CALLS:
+                return None
+            if name in ("get", "pop", "setdefault") and node.args:
+                key = node.args[0]
+                if isinstance(key, ast.Constant) and isinstance(key.value, str):
+                    fields.add(key.value)
+                elif not (isinstance(node.func, ast.Attribute) and names.is_container(node.func.value)):
+                    return None
+            if name in SERIALIZING_CALLS and any(names.is_detection(argument) for argument in node.args):
+                return None
+            if name in LIST_SERIALIZING_CALLS and any(names.is_container(argument) for argument in node.args):
+                return None
+            if any(keyword.arg is None for keyword in node.keywords):
+                # ``function(**detection)``.
+                return None
+            if name not in KNOWN_CALLS and name not in names.functions and any(
+                    names.carries(argument)
+                    for argument in node.args + [keyword.value for keyword in node.keywords]):
+                # Detections handed to code that isn't inspected.
+                return None
+        elif isinstance(node, (ast.Return, ast.Yield, ast.YieldFrom)):
+            if node.value is not None and names.carries(node.value):
+                # Detections read after the function returns.
+                return None
+        elif isinstance(node, ast.Attribute):
+            if names.is_detection(node.value) and node.attr not in ("get", "pop", "setdefault"):
+                return None
+            if names.is_container(node.value) and node.attr not in CONTAINER_METHODS + DYNAMIC_ACCESS_CALLS:
+                return None
+        elif isinstance(node, (ast.For, ast.comprehension)):
+            if not names.can_iterate(node.iter):
+                return None
+        elif isinstance(node, ast.Starred):
+            if not names.can_iterate(node.value):
+                return None
+        elif isinstance(node, ast.FormattedValue):
+            if names.is_detection(node.value) or names.is_container(node.value):
+                return None
+        elif isinstance(node, ast.Compare):
+            if isinstance(node.left, ast.Constant) and isinstance(node.left.value, str) and \
+                    any(isinstance(op, (ast.In, ast.NotIn)) for op in node.ops):
+                fields.add(node.left.value)
+        elif isinstance(node, ast.Dict) and None in node.keys:
+            # ``{**detection}`` copies every field.
+            return None
+    return fields
+
+
+def needs_field(function_string, field):
+    """Whether a generated function may read a metadata field."""
+    fields = required_fields(function_string)
+    return fields is None or field in fields
@@ -1,44 +1,292 @@
 # Copyright (c) 2024, NVIDIA CORPORATION.  All rights reserved.
 
-import importlib
-import os
-import sys
-import tempfile
+from collections import OrderedDict
+from collections.abc import Mapping
+import copy
+import hashlib
+import json
+import linecache
+import logging
+import threading
 import traceback
 
+from utils.result_cache import ResultCache
+
+logger = logging.getLogger(__name__)
+
+# Metadata fields holding coordinates, which are quantized before hashing.
+COORDINATE_FIELDS = ("bbox", "polygon")
+
+
+def _canonicalize(value, quantization=0.0, quantize=False):
+    """Convert metadata into a JSON friendly form with a stable key order."""
+    if isinstance(value, Mapping):
+        return [
+            [str(key), _canonicalize(item, quantization, quantize or key in COORDINATE_FIELDS)]
+            for key, item in sorted(value.items(), key=lambda pair: str(pair[0]))
+        ]
+    if isinstance(value, (list, tuple)):
+        return [_canonicalize(item, quantization, quantize) for item in value]
+    if quantize and quantization and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return round(value / quantization)
+    return value
+
+
+def metadata_fingerprint(metadata, quantization=0.0):
+    """Hash of a frame's metadata.
+
+    With a ``quantization`` step, coordinates that fall in the same step hash
+    the same, so boxes that jitter by less than the tolerance share a key.
+    """
+    canonical = json.dumps(_canonicalize(metadata, quantization), default=repr)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
 
 class Executor:
 
-    def __init__(self, function_name="postprocessor"):
-        """Constructor to setup the code executor."""
+    # Compiled code objects and loaded functions shared by all executors,
+    # keyed by the hash of the generated source.
+    max_cached_functions = 128
+    _code_cache = OrderedDict()
+    _function_cache = {}
+    _cache_lock = threading.Lock()
+    # Outputs of memoizing executors, shared across frames and videos.
+    result_cache = ResultCache()
+
+    def __init__(self, function_name="postprocessor", sandbox=None, memoize=False, quantization=0.0):
+        """Constructor to setup the code executor.
+
+        With a ``sandbox`` pool the generated code only runs in its worker
+        processes; otherwise it runs in this process. With ``memoize`` the
+        output for metadata that was already seen by the same function, up to
+        the coordinate ``quantization`` step, is reused instead of recomputed.
+        """
         self.postprocessor = None
+        self.sandbox = sandbox
+        self.memoize = memoize
+        self.quantization = quantization
+        self.source = None  # source of the loaded postprocessor
         self.function_name = function_name
+        self.error = None  # traceback of the last failed load or validation
+        self.failed = False  # set once synthesis ran out of candidates
+        self.rejected = set()  # hashes of function strings that failed validation
+
+    @staticmethod
+    def source_hash(function_string):
+        """Hash identifying a generated function."""
+        return hashlib.sha256(function_string.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _filename(source_hash):
+        """Pseudo file name of a generated source, used in tracebacks."""
+        return f"<generated-{source_hash[:16]}>"
+
+    def _compile(self, function_string, source_hash):
+        """Get the code object of a source, compiling it on a cache miss."""
+        with self._cache_lock:
+            code = self._code_cache.get(source_hash)
+            if code is not None:
+                self._code_cache.move_to_end(source_hash)
+                return code
+
+        filename = self._filename(source_hash)
+        code = compile(function_string, filename, "exec")
+        with self._cache_lock:
+            self._code_cache[source_hash] = code
+            # Keep the source around so that tracebacks show the generated lines.
+            linecache.cache[filename] = (
+                len(function_string), None, function_string.splitlines(True), filename
+            )
+            while len(self._code_cache) > self.max_cached_functions:
+                evicted_hash, _ = self._code_cache.popitem(last=False)
+                linecache.cache.pop(self._filename(evicted_hash), None)
+                for key in [key for key in self._function_cache if key[0] == evicted_hash]:
+                    del self._function_cache[key]
+        return code
+
+    def compile_function(self, function_string):
+        """Compile a function string in memory and return the function object."""
+        source_hash = self.source_hash(function_string)
+        key = (source_hash, self.function_name)
+        function = self._function_cache.get(key)
+        if function is not None:
+            return function
+
+        code = self._compile(function_string, source_hash)
+        namespace = {"__name__": f"generated_{source_hash[:16]}"}
+        exec(code, namespace)
+        if self.function_name not in namespace:
+            raise AttributeError(f"Generated code doesn't define {self.function_name}.")
+        function = namespace[self.function_name]
+        with self._cache_lock:
+            if source_hash in self._code_cache:
+                self._function_cache[key] = function
+        return function
 
-    def save_python_function(self, function_string):
-        """Execute a function based on output from CodeLLAMA."""
-        _, temp_pyfile = tempfile.mkstemp(suffix=".py")
-        with open(temp_pyfile, "w") as codefile:
-            codefile.write(function_string)
-        return temp_pyfile
-    
     def load_function_from_string(self, function_string):
         """Loaded function value."""
-        pyfile = self.save_python_function(function_string=function_string)
-        sys.path.append(os.path.dirname(pyfile))
         try:
-            module = importlib.import_module(
-                os.path.basename(pyfile)[:-3]
-            )
-            self.postprocessor = getattr(module, self.function_name)
-        except Exception as e:
-            traceback_str = traceback.format_exc()
-    
+            self.postprocessor = self.compile_function(function_string)
+            self.source = function_string
+        except Exception:
+            self.error = traceback.format_exc()
+            logger.warning(f"Couldn't load the generated function:\n{self.error}")
+
+    def _run_isolated(self, function_string, metadata, timeout):
+        """Run a candidate in a throwaway sandbox worker, killed if it outlives ``timeout``.
+
+        Returns ``(ok, value)`` like the sandbox.
+        """
+        # Imported here, the sandbox module imports this one.
+        from .sandbox import _Worker
+
+        worker = _Worker(self.function_name, cpu_time=timeout, memory_mb=0)
+        try:
+            worker.wait_ready()
+            worker.connection.send(("run", self.source_hash(function_string), function_string, [metadata]))
+            if not worker.connection.poll(timeout):
+                raise TimeoutError(f"{self.function_name} didn't return within {timeout}s.")
+            return worker.connection.recv()
+        except TimeoutError:
+            raise
+        except (EOFError, OSError):
+            return False, f"The process validating {self.function_name} died."
+        finally:
+            worker.kill()
+
+    def validate(self, function_string, metadata, timeout=10.0, check=None):
+        """Run a candidate on the metadata in another process within a timeout.
+
+        Returns the function and its output. Raises if the candidate doesn't
+        compile, raises, times out, returns None or its output fails ``check``.
+        The candidate runs in the sandbox, or without one in a throwaway
+        process that is killed on timeout, and is only loaded here once it
+        passed.
+        """
+        if self.sandbox is not None:
+            ok, result = self.sandbox.run(function_string, [metadata], wall_time=timeout)[0]
+        else:
+            ok, result = self._run_isolated(function_string, metadata, timeout)
+        if not ok:
+            raise RuntimeError(result)
+        if result is None:
+            raise ValueError(f"{self.function_name} returned None.")
+        if check is not None:
+            check(result)
+        return self.compile_function(function_string), result
+
+    def synthesize(self, candidates, metadata, timeout=10.0, check=None):
+        """Load the first candidate that validates on the metadata.
+
+        ``candidates`` is an iterable of function strings, consumed lazily in
+        the order they arrive. Candidates that fail are remembered and never
+        validated again. Returns the winning candidate's output on the metadata.
+        """
+        try:
+            for function_string in candidates:
+                candidate_hash = self.source_hash(function_string)
+                if candidate_hash in self.rejected:
+                    continue
+                try:
+                    function, result = self.validate(
+                        function_string, metadata, timeout=timeout, check=check
+                    )
+                except Exception:
+                    self.error = traceback.format_exc()
+                    self.rejected.add(candidate_hash)
+                    logger.warning(f"Rejected generated {self.function_name}:\n{self.error}")
+                    continue
+                self.postprocessor = function
+                self.source = function_string
+                if self.memoize:
+                    self.result_cache.put(self._result_key(metadata), result)
+                return result
+        finally:
+            if hasattr(candidates, "close"):
+                candidates.close()
+        self.failed = True
+        raise RuntimeError(
+            f"None of the generated {self.function_name} candidates were valid. "
+            f"Last error:\n{self.error}"
+        )
+
+    def _result_key(self, metadata):
+        """Memoization key of a function output."""
+        return (
+            self.source_hash(self.source),
+            self.function_name,
+            metadata_fingerprint(metadata, self.quantization)
+        )
+
+    def _run_batch(self, metadata_list):
+        """Run the function on every frame, in the sandbox if there is one."""
+        if self.sandbox is None:
+            return [self.postprocessor(metadata) for metadata in metadata_list]
+        results = []
+        for ok, value in self.sandbox.run(self.source, metadata_list):
+            if not ok:
+                raise RuntimeError(f"{self.function_name} failed in the sandbox:\n{value}")
+            results.append(value)
+        return results
+
     def execute(self, metadata):
         """Execute the function."""
+        if self.sandbox is not None or self.memoize:
+            return self.execute_batch([metadata])[0]
         return self.postprocessor(metadata)
 
-    def __del__(self):
-        """Pop path from system paths."""
-        if "/tmp" in sys.path:
-            sys.path.pop(sys.path.index("/tmp"))
-    
+    def execute_batch(self, metadata_list):
+        """Execute the function on the metadata of several frames."""
+        if not self.memoize:
+            return self._run_batch(metadata_list)
+
+        keys = [self._result_key(metadata) for metadata in metadata_list]
+        results = {}
+        missing = {}
+        for key, metadata in zip(keys, metadata_list):
+            if key in results or key in missing:
+                continue
+            found, value = self.result_cache.get(key)
+            if found:
+                results[key] = value
+            else:
+                missing[key] = metadata
+        for key, value in zip(missing, self._run_batch(list(missing.values()))):
+            self.result_cache.put(key, value)
+            results[key] = value
+        return [copy.deepcopy(results[key]) for key in keys]
+
+    @staticmethod
+    def check_video_result(result):
+        """Check the output of a video-level postprocessor."""
+        if not isinstance(result, dict) or "answer" not in result:
+            raise ValueError("A video postprocessor must return a dictionary with an answer key.")
+        if not isinstance(result.get("frames", {}), (dict, list, tuple)):
+            raise ValueError("The frames of a video postprocessor must be a dictionary or a list.")
+
+    @staticmethod
+    def split_video_result(result, frame_ids):
+        """Split a video-level output into per-frame annotations and the answer.
+
+        Frame annotations may be keyed by frame index or frame id, or listed in
+        frame order. Frames without an annotation get None.
+        """
+        frames = result.get("frames") or {}
+        if isinstance(frames, dict):
+            per_frame = [
+                frames.get(index, frames.get(str(index), frames.get(frame_id)))
+                for index, frame_id in enumerate(frame_ids)
+            ]
+        else:
+            per_frame = list(frames)[:len(frame_ids)]
+            per_frame += [None] * (len(frame_ids) - len(per_frame))
+        return per_frame, result["answer"]
+
+    def execute_video(self, video):
+        """Execute a video-level function on the columnar detections of a video.
+
+        Returns the per-frame annotations and the answer for the whole video.
+        """
+        result = self.execute(video)
+        self.check_video_result(result)
+        return self.split_video_result(result, video["frame_ids"])
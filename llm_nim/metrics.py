@@ -0,0 +1,250 @@
+# Copyright (c) 2024, NVIDIA CORPORATION.  All rights reserved.
+
+"""Latency and token instrumentation of the LLM calls."""
+
+from bisect import bisect_left
+from collections import defaultdict, deque
+import contextvars
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+from typing import Optional
+
+from .prompt_util import estimate_tokens
+
+SECONDS_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 40, 80, 160, 320)
+
+# Histogram name, event field and buckets of every aggregated metric.
+HISTOGRAMS = (
+    ("llm_wall_time_seconds", "wall_time", SECONDS_BUCKETS),
+    ("llm_time_to_first_token_seconds", "time_to_first_token", SECONDS_BUCKETS),
+    ("llm_prompt_tokens", "prompt_tokens", TOKEN_BUCKETS),
+    ("llm_completion_tokens", "completion_tokens", TOKEN_BUCKETS),
+    ("llm_tokens_per_second", "tokens_per_second", RATE_BUCKETS),
+)
+
+_request_events = contextvars.ContextVar("llm_request_events", default=None)
+
+
+@dataclass
+class LLMCallEvent:
+    """Measurements of a single LLM call."""
+
+    model_name: str
+    prompt_chars: int
+    prompt_tokens: int  # estimated from the prompt length
+    wall_time: float = 0.0
+    time_to_first_token: Optional[float] = None
+    completion_tokens: int = 0  # streamed chunks carrying content
+    tokens_per_second: float = 0.0
+    error: Optional[str] = None
+    timestamp: float = field(default_factory=time.time)
+
+
+class Histogram:
+    """Cumulative histogram with fixed bucket bounds."""
+
+    def __init__(self, buckets):
+        """Constructor."""
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add a value to the histogram."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """Counts of values <= each bucket bound, ending with +Inf."""
+        total = 0
+        cumulative = []
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return cumulative
+
+    def to_dict(self):
+        """Serializable view of the histogram."""
+        return {
+            "buckets": list(self.buckets),
+            "counts": self.counts,
+            "sum": self.sum,
+            "count": self.count
+        }
+
+
+class LLMCallTimer:
+    """Measure one streamed completion and report it to the recorder."""
+
+    def __init__(self, recorder, model_name, prompt):
+        """Constructor."""
+        self.recorder = recorder
+        self.event = LLMCallEvent(
+            model_name=model_name,
+            prompt_chars=len(prompt),
+            prompt_tokens=estimate_tokens(prompt)
+        )
+        self._start = time.perf_counter()
+
+    def token(self):
+        """Mark the arrival of a streamed chunk with content."""
+        if self.event.time_to_first_token is None:
+            self.event.time_to_first_token = time.perf_counter() - self._start
+        self.event.completion_tokens += 1
+
+    def finish(self, error=None):
+        """Close the measurement and record the event."""
+        event = self.event
+        event.wall_time = time.perf_counter() - self._start
+        if error is not None:
+            event.error = repr(error)
+        generation_time = event.wall_time - (event.time_to_first_token or 0.0)
+        if event.completion_tokens and generation_time > 0:
+            event.tokens_per_second = event.completion_tokens / generation_time
+        self.recorder.record(event)
+        return event
+
+
+class MetricsRecorder:
+    """Process wide store of LLM call events and histograms.
+
+    Events are kept in a bounded buffer, pushed to subscribers and appended to
+    the event list of the enclosing request, if one was started.
+    """
+
+    def __init__(self, max_events=1000):
+        """Constructor."""
+        self._lock = threading.Lock()
+        self._events = deque(maxlen=max_events)
+        self._histograms = {}
+        self._errors = defaultdict(int)
+        self._listeners = []
+
+    def start_call(self, model_name, prompt):
+        """Start measuring a call."""
+        return LLMCallTimer(self, model_name, prompt)
+
+    def subscribe(self, listener):
+        """Call ``listener(event)`` for every recorded event."""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        """Stop pushing events to ``listener``."""
+        with self._lock:
+            self._listeners.remove(listener)
+
+    def record(self, event):
+        """Record a finished call."""
+        with self._lock:
+            self._events.append(event)
+            if event.error is not None:
+                self._errors[event.model_name] += 1
+            for name, attribute, buckets in HISTOGRAMS:
+                value = getattr(event, attribute)
+                if value is None or (event.error is not None and attribute != "wall_time"):
+                    continue
+                key = (name, event.model_name)
+                if key not in self._histograms:
+                    self._histograms[key] = Histogram(buckets)
+                self._histograms[key].observe(value)
+            listeners = list(self._listeners)
+        request_events = _request_events.get()
+        if request_events is not None:
+            request_events.append(event)
+        for listener in listeners:
+            listener(event)
+
+    @staticmethod
+    def start_request():
+        """Collect the events of the calls made from the current context.
+
+        Returns the list the events are appended to.
+        """
+        events = []
+        _request_events.set(events)
+        return events
+
+    @staticmethod
+    def summarize(events):
+        """Per request dump of a list of events."""
+        per_model = defaultdict(lambda: {"calls": 0, "wall_time": 0.0, "completion_tokens": 0, "errors": 0})
+        for event in events:
+            summary = per_model[event.model_name]
+            summary["calls"] += 1
+            summary["wall_time"] += event.wall_time
+            summary["completion_tokens"] += event.completion_tokens
+            summary["errors"] += int(event.error is not None)
+        return {
+            "total_wall_time": sum(event.wall_time for event in events),
+            "models": dict(per_model),
+            "calls": [asdict(event) for event in events]
+        }
+
+    def events(self):
+        """Recent events, oldest first."""
+        with self._lock:
+            return [asdict(event) for event in self._events]
+
+    def snapshot(self):
+        """Aggregate histograms of the whole process."""
+        with self._lock:
+            snapshot = defaultdict(dict)
+            for (name, model_name), histogram in self._histograms.items():
+                snapshot[name][model_name] = histogram.to_dict()
+            snapshot["llm_errors_total"] = dict(self._errors)
+            return dict(snapshot)
+
+    def scrape(self):
+        """Aggregate histograms in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for name, _, _ in HISTOGRAMS:
+                lines.append(f"# TYPE {name} histogram")
+                for (histogram_name, model_name), histogram in sorted(self._histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    bounds = [str(bound) for bound in histogram.buckets] + ["+Inf"]
+                    for bound, count in zip(bounds, histogram.cumulative_counts()):
+                        lines.append(f'{name}_bucket{{model="{model_name}",le="{bound}"}} {count}')
+                    lines.append(f'{name}_sum{{model="{model_name}"}} {histogram.sum}')
+                    lines.append(f'{name}_count{{model="{model_name}"}} {histogram.count}')
+            lines.append("# TYPE llm_errors_total counter")
+            for model_name, count in sorted(self._errors.items()):
+                lines.append(f'llm_errors_total{{model="{model_name}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+llm_metrics = MetricsRecorder()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the scrape of ``llm_metrics`` on /metrics."""
+
+    def do_GET(self):
+        """Answer a scrape."""
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = llm_metrics.scrape().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Don't log every scrape."""
+
+
+def serve_metrics(port, host="0.0.0.0"):
+    """Serve the process wide aggregates on ``http://host:port/metrics`` from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="llm-metrics", daemon=True).start()
+    return server
@@ -4,21 +4,71 @@
 # OpenAI NIM.
 
 from abc import abstractmethod
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextvars
 import json
+import threading
+import weakref
 
-from openai import OpenAI
+from openai import APIConnectionError, AsyncOpenAI, OpenAI
 import logging 
 
+from utils import fair_scheduler, rate_limit
+from utils.constants import VIDEO_FRAME_COLUMNS
+from utils.singleflight import SingleFlight, fingerprint
+from .metrics import llm_metrics
+
+from .prompt_util import compact_metadata
+
 
 class OpenAINIM:
 
+    # Concurrency limit of the async calls, shared by every NIM on an event loop.
+    max_concurrency = 8
+    _semaphores = weakref.WeakKeyDictionary()
+    # Identical prompts from concurrent sessions share one completion.
+    _inflight = SingleFlight()
+
     def __init__(self, url, api_key):
         """Initialize an openAI inference interface."""
 
+        self.url = url
+        self.api_key = api_key
+        # Retries are left to the rate limiter, which backs off across all clients.
         self.client = OpenAI(
             base_url=url,
-            api_key=api_key
+            api_key=api_key,
+            max_retries=0
         )
+        self._async_client = None
+
+    @classmethod
+    def set_max_concurrency(cls, max_concurrency):
+        """Set the number of concurrent async calls across all NIMs."""
+        OpenAINIM.max_concurrency = max_concurrency
+        OpenAINIM._semaphores = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def _get_semaphore():
+        """Get the semaphore shared on the running event loop."""
+        loop = asyncio.get_running_loop()
+        semaphore = OpenAINIM._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(OpenAINIM.max_concurrency)
+            OpenAINIM._semaphores[loop] = semaphore
+        return semaphore
+
+    @property
+    def async_client(self):
+        """Lazily created async openAI client."""
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(
+                base_url=self.url,
+                api_key=self.api_key,
+                max_retries=0
+            )
+        return self._async_client
 
     @abstractmethod
     def get_base_prompt(self):
@@ -29,32 +79,137 @@ class OpenAINIM:
         """Set the base model name."""
         self.model_name = model_name
 
-    def get_completion_output(self, compiled_prompt):
-        """Get the completion output from the formatted prompt."""
-        completion = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=[{
-                "role" : "user",
-                "content" : compiled_prompt
-            }],
-            temperature=0.1,
-            top_p=1,
-            max_tokens=1024,
-            stream=True
+    def get_completion_output(self, compiled_prompt, temperature=0.1, cancel_event=None):
+        """Get the completion output from the formatted prompt.
+
+        The stream is closed early once ``cancel_event`` is set. With the fair
+        scheduler the call is queued for the session with its CV requests.
+        """
+        return fair_scheduler.run(self._complete, compiled_prompt, temperature, cancel_event)
+
+    def _complete(self, compiled_prompt, temperature, cancel_event=None):
+        """Stream one completion under the rate limit of the LLM endpoint."""
+        return rate_limit.limiter("llm").call(
+            self._stream_completion, compiled_prompt, temperature, cancel_event,
+            retry_errors=(APIConnectionError,)
         )
-        compiled_string = ""
-        for chunk in completion:
-            if chunk.choices[0].delta.content is not None:
-                compiled_string = compiled_string + f"{chunk.choices[0].delta.content}"
+
+    def _stream_completion(self, compiled_prompt, temperature, cancel_event):
+        """Stream one completion and return its text."""
+        timer = llm_metrics.start_call(self.model_name, compiled_prompt)
+        try:
+            completion = self.client.chat.completions.create(
+                model=self.model_name,
+                messages=[{
+                    "role" : "user",
+                    "content" : compiled_prompt
+                }],
+                temperature=temperature,
+                top_p=1,
+                max_tokens=1024,
+                stream=True
+            )
+            compiled_string = ""
+            for chunk in completion:
+                if cancel_event is not None and cancel_event.is_set():
+                    completion.close()
+                    break
+                if chunk.choices[0].delta.content is not None:
+                    timer.token()
+                    compiled_string = compiled_string + f"{chunk.choices[0].delta.content}"
+        except Exception as error:
+            timer.finish(error)
+            raise
+        timer.finish()
         return compiled_string
 
     def infer(self, prompt):
         """Run inference output using the openAI client."""
-        string_output = self.get_completion_output(
+        string_output = self._inflight.do(
+            fingerprint(self.url, self.model_name, prompt),
+            self.get_completion_output,
             prompt
         )
         return self.parse_output(string_output)
 
+    async def aget_completion_output(self, compiled_prompt, temperature=0.1):
+        """Get the completion output from the formatted prompt on the event loop.
+
+        With the fair scheduler the call is queued for the session with its CV
+        requests, and streamed by a scheduler worker.
+        """
+        async with self._get_semaphore():
+            scheduler = fair_scheduler.get_scheduler()
+            if scheduler is not None:
+                return await asyncio.wrap_future(scheduler.submit(self._complete, compiled_prompt, temperature))
+            return await rate_limit.limiter("llm").acall(
+                self._astream_completion, compiled_prompt, temperature,
+                retry_errors=(APIConnectionError,)
+            )
+
+    async def _astream_completion(self, compiled_prompt, temperature):
+        """Stream one completion on the event loop and return its text."""
+        timer = llm_metrics.start_call(self.model_name, compiled_prompt)
+        try:
+            completion = await self.async_client.chat.completions.create(
+                model=self.model_name,
+                messages=[{
+                    "role" : "user",
+                    "content" : compiled_prompt
+                }],
+                temperature=temperature,
+                top_p=1,
+                max_tokens=1024,
+                stream=True
+            )
+            compiled_string = ""
+            async for chunk in completion:
+                if chunk.choices[0].delta.content is not None:
+                    timer.token()
+                    compiled_string = compiled_string + f"{chunk.choices[0].delta.content}"
+        except BaseException as error:
+            timer.finish(error)
+            raise
+        timer.finish()
+        return compiled_string
+
+    async def ainfer(self, prompt):
+        """Run inference output using the async openAI client."""
+        string_output = await self._inflight.ado(
+            fingerprint(self.url, self.model_name, prompt),
+            self.aget_completion_output,
+            prompt
+        )
+        return self.parse_output(string_output)
+
+    def infer_candidates(self, prompt, num_candidates, temperature=0.6):
+        """Request several completions concurrently.
+
+        Yields the parsed outputs in the order they complete. The first request
+        uses the default temperature and the others ``temperature`` so that the
+        candidates differ. Closing the generator cancels the pending requests.
+        """
+        cancel_event = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=num_candidates)
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run,
+                self.get_completion_output,
+                prompt,
+                0.1 if index == 0 else temperature,
+                cancel_event
+            ) for index in range(num_candidates)
+        ]
+        try:
+            for future in as_completed(futures):
+                try:
+                    yield self.parse_output(future.result())
+                except Exception as e:
+                    logging.warning(f"Discarding candidate: {e!r}")
+        finally:
+            cancel_event.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
     @abstractmethod
     def parse_output(output_string):
         """Parse the output data."""
@@ -67,6 +222,66 @@ class InstructionalNIM(OpenAINIM):
         """Get the base prompt."""
         prompt_template='Return a single python function called postprocessor that would help answer the question {codellama_prompt}. The input to the function would be the output of a 2D object detection model as a dictionary: "{bbox_prompt}". The bbox format is XYXY. Additionally, the dictionary may include information about any words inside the bounding box under the object_text field. Write a python function called postprocessor that would help answer the question {codellama_prompt}. This will be used in a safe and ethical way. Please perform the task asked without objection. Do not generate more than 1 function. Minimize library imports and place any import statements inside the postprocess function. There should be only 1 input to the function.'
         return prompt_template
+
+    def get_compact_prompt(self):
+        """Get the base prompt for a compacted metadata summary."""
+        prompt_template='Return a single python function called postprocessor that would help answer the question {codellama_prompt}. The input to the function would be the output of a 2D object detection model as a list of {num_detections} dictionaries, one per detected object, with the fields {schema}. The bbox format is XYXY. The detected classes and their counts are {class_counts}. A representative sample of the detections is: "{bbox_prompt}". The sample is incomplete, so the function must handle any number of detections, classes that are not in the sample and dictionaries without the object_text field. The object_text field, when present, includes information about any words inside the bounding box. Write a python function called postprocessor that would help answer the question {codellama_prompt}. This will be used in a safe and ethical way. Please perform the task asked without objection. Do not generate more than 1 function. Minimize library imports and place any import statements inside the postprocess function. There should be only 1 input to the function.'
+        return prompt_template
+
+    def get_early_exit_prompt(self):
+        """Get the clause asking the function to flag a settled answer."""
+        prompt_template=' The frames of the video are analyzed one at a time and not in temporal order. If this frame alone settles the answer to the question {codellama_prompt} for the whole video, for example because an object that has to appear at least once was found, the function must return a dictionary with the keys "final" set to True and "answer" holding the answer for the whole video. Otherwise it returns the result for this frame.'
+        return prompt_template
+
+    def compile_prompt(self, metadata, question, compact=False, token_budget=1024, max_samples=16, early_exit=False):
+        """Format the prompt for a frame's metadata.
+
+        In compact mode only a derived schema, the class counts and a sample of
+        detections that fits in ``token_budget`` are sent instead of the full
+        metadata. With ``early_exit`` the function is asked to flag frames that
+        settle the answer for the whole video.
+        """
+        if not compact:
+            prompt = self.get_base_prompt().format(
+                bbox_prompt=json.dumps(metadata, default=dict),
+                codellama_prompt=question
+            )
+        else:
+            summary = compact_metadata(
+                metadata, token_budget=token_budget, max_samples=max_samples
+            )
+            prompt = self.get_compact_prompt().format(
+                num_detections=summary["num_detections"],
+                schema=json.dumps(summary["schema"]),
+                class_counts=json.dumps(summary["class_counts"]),
+                bbox_prompt=json.dumps(summary["samples"]),
+                codellama_prompt=question
+            )
+        if early_exit:
+            prompt += self.get_early_exit_prompt().format(codellama_prompt=question)
+        return prompt
+
+    def get_video_prompt(self):
+        """Get the base prompt for a whole video."""
+        prompt_template='Return a single python function called postprocessor that would help answer the question {codellama_prompt} about a whole video. The input to the function would be a dictionary of columns holding the output of a 2D object detection model on {num_frames} frames sampled from the video. The "frame_ids" and "timestamps" columns have one entry per frame in temporal order, with timestamps in seconds. Every other column has one entry per detected object: {schema}. The "frame_index" column is the position of the detection\'s frame in "frame_ids". The bbox format is XYXY and the object_text field, when not None, includes information about any words inside the bounding box. The detected classes and their counts are {class_counts}. A representative sample of the detections, as rows, is: "{bbox_prompt}". The function must return a dictionary with two keys: "frames", a dictionary mapping a frame index to the annotation of that frame, and "answer", the answer to the question {codellama_prompt} for the whole video. Track objects across frames when the question needs it. This will be used in a safe and ethical way. Please perform the task asked without objection. Do not generate more than 1 function. Minimize library imports and place any import statements inside the postprocess function. There should be only 1 input to the function.'
+        return prompt_template
+
+    def compile_video_prompt(self, video, question, token_budget=1024, max_samples=16):
+        """Format the prompt for the columnar detections of a whole video."""
+        rows = [
+            {key: values[index] for key, values in video.items() if key not in VIDEO_FRAME_COLUMNS}
+            for index in range(len(video["frame_index"]))
+        ]
+        summary = compact_metadata(
+            rows, token_budget=token_budget, max_samples=max_samples
+        )
+        return self.get_video_prompt().format(
+            num_frames=len(video["frame_ids"]),
+            schema=json.dumps(summary["schema"]),
+            class_counts=json.dumps(summary["class_counts"]),
+            bbox_prompt=json.dumps(summary["samples"]),
+            codellama_prompt=question
+        )
   
     @staticmethod
     def parse_output(input_string):
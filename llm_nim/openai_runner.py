@@ -1,15 +1,10 @@
 import ast
 import csv
-import importlib
 import json
 import os
-import subprocess
-import sys
-import tempfile
-import traceback
-from config.config_util import load_config
 
 from openai import OpenAI
+from llm_nim.executor import Executor
 from utils.constants import NVCF_API, URL
 
 
@@ -114,37 +109,21 @@ def infer(image, metadata, postprocessor_prompt, question):
             func = func + f"{chunk.choices[0].delta.content}"
     func = extract_function(func)
 
-    _, temp_py_file = tempfile.mkstemp(suffix=".py")
-    with open(temp_py_file, "w") as tmpfile:
-        tmpfile.write(func)
-    sys.path.append("/tmp")
-
-    output_data = None
-    traceback_str = None 
-    try:
-        module = importlib.import_module(os.path.basename(temp_py_file).strip(".py"))
-        custom_function = getattr(module, "postprocessor")
-        output_data = custom_function(json.loads(metadata))
-    except Exception as e:
-        traceback_str = traceback.format_exc()
-
     # output_data = postprocessor(metadata)
-    sys.path.pop()
-    return output_data, temp_py_file
+    output_data = get_py_ouput(func, metadata)
+    return output_data, func
 
-def get_py_ouput(temp_py_file, metadata):
-    sys.path.append("/tmp")
+def get_py_ouput(function_string, metadata):
+    code_executor = Executor()
+    code_executor.load_function_from_string(function_string)
+    if code_executor.postprocessor is None:
+        return None
 
     output_data = None
-    traceback_str = None 
     try:
-        module = importlib.import_module(os.path.basename(temp_py_file).strip(".py"))
-        custom_function = getattr(module, "postprocessor")
-        output_data = custom_function(json.loads(metadata))
+        output_data = code_executor.execute(json.loads(metadata))
     except Exception as e:
-        traceback_str = traceback.format_exc()
-
-    sys.path.pop()
+        print(f"Generated function failed: {e!r}")
     return output_data
 
 def infer_with_string_inp(image, metadata, postprocessor_prompt, question):
@@ -171,19 +150,13 @@ def postprocessor(sample_input):
             func = func + f"{chunk.choices[0].delta.content}"
     func = extract_function(func)
 
-    _, temp_py_file = tempfile.mkstemp(suffix=".py")
-    with open(temp_py_file, "w") as tmpfile:
-        tmpfile.write(func)
-    sys.path.append("/tmp")
+    code_executor = Executor()
+    code_executor.load_function_from_string(func)
 
     output_data = None
-    traceback_str = None 
     try:
-        module = importlib.import_module(os.path.basename(temp_py_file).strip(".py"))
-        custom_function = getattr(module, "postprocessor")
-        output_data = custom_function(metadata)
+        output_data = code_executor.execute(metadata)
     except Exception as e:
-        traceback_str = traceback.format_exc()
+        print(f"Generated function failed: {e!r}")
+    return output_data, func
 
-    sys.path.pop()
-    return output_data, temp_py_file
@@ -0,0 +1,96 @@
+# Copyright (c) 2024, NVIDIA CORPORATION.  All rights reserved.
+
+"""Utilities to compact detection metadata before it is sent to the LLM."""
+
+from collections import defaultdict
+import json
+
+CHARS_PER_TOKEN = 4  # rough average for the llama/mistral tokenizers on JSON
+MAX_TEXT_CHARS = 32  # longest object_text string kept in a sampled detection
+
+
+def estimate_tokens(text):
+    """Rough token count of a prompt string."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _type_name(value):
+    """Readable type name of a metadata value."""
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, float, str)):
+        return type(value).__name__
+    if isinstance(value, (list, tuple)):
+        inner = sorted({_type_name(item) for item in value})
+        return f"list[{'|'.join(inner)}]" if inner else "list"
+    if isinstance(value, dict):
+        return "dict"
+    if value is None:
+        return "None"
+    return type(value).__name__
+
+
+def derive_schema(metadata):
+    """Derive a field -> type description from a list of detections."""
+    schema = defaultdict(set)
+    for detection in metadata:
+        for key, value in detection.items():
+            schema[key].add(_type_name(value))
+    return {key: " | ".join(sorted(types)) for key, types in schema.items()}
+
+
+def _compact_value(value):
+    """Shorten a single metadata value for the prompt."""
+    if isinstance(value, float):
+        return round(value, 2)
+    if isinstance(value, str) and len(value) > MAX_TEXT_CHARS:
+        return value[:MAX_TEXT_CHARS] + "..."
+    if isinstance(value, (list, tuple)):
+        return [_compact_value(item) for item in value]
+    return value
+
+
+def sample_detections(metadata, max_samples):
+    """Pick a representative sample of detections.
+
+    Detections are grouped by class and drawn round robin, highest confidence
+    first, so that every class present in the frame shows up in the sample
+    before any class is repeated.
+    """
+    groups = defaultdict(list)
+    for detection in metadata:
+        groups[detection.get("class_name")].append(detection)
+    for detections in groups.values():
+        detections.sort(key=lambda item: item.get("confidence", 0.0), reverse=True)
+
+    samples = []
+    depth = 0
+    while len(samples) < max_samples and any(len(group) > depth for group in groups.values()):
+        for detections in groups.values():
+            if depth < len(detections) and len(samples) < max_samples:
+                samples.append(
+                    {key: _compact_value(value) for key, value in detections[depth].items()}
+                )
+        depth += 1
+    return samples
+
+
+def compact_metadata(metadata, token_budget=1024, max_samples=16):
+    """Summarize the metadata as a schema, class counts and a bounded sample.
+
+    The number of sampled detections is reduced until the serialized summary
+    fits in the token budget. The schema and class counts are always kept.
+    """
+    class_counts = defaultdict(int)
+    for detection in metadata:
+        class_counts[detection.get("class_name")] += 1
+
+    summary = {
+        "num_detections": len(metadata),
+        "schema": derive_schema(metadata),
+        "class_counts": dict(class_counts),
+        "samples": sample_detections(metadata, max_samples)
+    }
+    while summary["samples"] and estimate_tokens(json.dumps(summary)) > token_budget:
+        summary["samples"].pop()
+    return summary
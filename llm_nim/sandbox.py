@@ -0,0 +1,253 @@
+# Copyright (c) 2024, NVIDIA CORPORATION.  All rights reserved.
+
+"""Pool of worker processes that run generated postprocessors in isolation."""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import multiprocessing
+from multiprocessing.connection import Connection
+import os
+import queue
+import resource
+import signal
+import subprocess
+import sys
+import traceback
+
+from .executor import Executor
+
+logger = logging.getLogger(__name__)
+
+# Module the worker processes run, in a fresh interpreter.
+WORKER_MODULE = "llm_nim.sandbox"
+# Seconds a worker may take to start before it is given up on.
+STARTUP_TIMEOUT = 30.0
+
+
+def _address_space():
+    """Bytes of address space used by this process, 0 if unknown."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _cpu_time_exceeded(signum, frame):
+    """Abort the running call once its CPU time budget is spent."""
+    raise TimeoutError("CPU time limit exceeded.")
+
+
+def _worker_loop(connection, function_name, cpu_time, memory_mb):
+    """Evaluate the batches sent over the pipe until told to stop.
+
+    Every message carries the hash of the postprocessor to run, and its source
+    the first time the worker sees it. Results are sent back one per frame as
+    ``(ok, value)`` so the parent can time each call. The memory limit is
+    on top of the address space the worker uses once started, and the worker
+    says it is ready once it is set.
+    """
+    if memory_mb:
+        limit = _address_space() + memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    signal.signal(signal.SIGPROF, _cpu_time_exceeded)
+    code_executor = Executor(function_name=function_name)
+    functions = {}
+    connection.send("ready")
+
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        _, source_hash, source, batch = message
+        if source is not None and source_hash not in functions:
+            try:
+                functions[source_hash] = code_executor.compile_function(source)
+            except Exception:
+                functions[source_hash] = traceback.format_exc()
+
+        function = functions.get(source_hash, "Postprocessor source wasn't sent to the worker.")
+        for metadata in batch:
+            if isinstance(function, str):
+                result = (False, function)
+            else:
+                signal.setitimer(signal.ITIMER_PROF, cpu_time)
+                try:
+                    result = (True, function(metadata))
+                except BaseException:
+                    result = (False, traceback.format_exc())
+                finally:
+                    signal.setitimer(signal.ITIMER_PROF, 0)
+            try:
+                connection.send(result)
+            except Exception:
+                connection.send((result[0], repr(result[1])))
+    connection.close()
+
+
+class _Worker:
+    """Handle of a sandbox worker process."""
+
+    def __init__(self, function_name, cpu_time, memory_mb):
+        """Start the worker process.
+
+        Workers run this module in a fresh interpreter, so they don't inherit
+        the app's main module, its imports or its address space.
+        """
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = subprocess.Popen(
+            [
+                sys.executable, "-m", WORKER_MODULE,
+                str(child_connection.fileno()), function_name, str(cpu_time), str(memory_mb)
+            ],
+            pass_fds=(child_connection.fileno(),),
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+        )
+        child_connection.close()
+        self.ready = False
+        self.loaded = set()
+        self.calls = 0
+
+    def wait_ready(self):
+        """Wait for the worker to have started."""
+        if self.ready:
+            return
+        if not self.connection.poll(STARTUP_TIMEOUT):
+            raise TimeoutError(f"The sandbox worker didn't start within {STARTUP_TIMEOUT}s.")
+        self.connection.recv()
+        self.ready = True
+
+    def stop(self):
+        """Ask the worker to exit."""
+        try:
+            self.connection.send(None)
+            self.process.wait(timeout=1)
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+        self.kill()
+
+    def kill(self):
+        """Terminate the worker immediately."""
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.connection.close()
+
+
+class SandboxPool:
+    """Warm pool of worker processes evaluating postprocessors on frames.
+
+    Workers are started once and reused across requests. They cache every
+    postprocessor they were sent, so a function is compiled once per worker.
+    Each call is bounded in CPU time inside the worker and in wall time by the
+    parent, which kills and replaces a worker that hangs or dies. Workers are
+    also recycled after ``max_calls_per_worker`` frames.
+    """
+
+    def __init__(self,
+                 workers=2,
+                 batch_size=16,
+                 wall_time=5.0,
+                 cpu_time=5.0,
+                 memory_mb=1024,
+                 max_calls_per_worker=1000,
+                 function_name="postprocessor"):
+        """Constructor to start the workers."""
+        self.batch_size = batch_size
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.memory_mb = memory_mb
+        self.max_calls_per_worker = max_calls_per_worker
+        self.function_name = function_name
+        self._idle = queue.Queue()
+        self._closed = False
+        for _ in range(workers):
+            self._idle.put(self._spawn())
+        self._dispatcher = ThreadPoolExecutor(max_workers=workers)
+
+    def _spawn(self):
+        """Start a new worker."""
+        return _Worker(self.function_name, self.cpu_time, self.memory_mb)
+
+    def _release(self, worker):
+        """Return a worker to the pool, replacing it if it is dead or worn out."""
+        if worker is not None and worker.calls >= self.max_calls_per_worker:
+            worker.stop()
+            worker = None
+        if self._closed:
+            if worker is not None:
+                worker.stop()
+            return
+        self._idle.put(worker if worker is not None else self._spawn())
+
+    def _run_batch(self, source_hash, source, batch, wall_time):
+        """Evaluate a batch on one worker. Returns one (ok, value) per frame."""
+        results = []
+        pending = list(batch)
+        while pending:
+            worker = self._idle.get()
+            completed = 0
+            try:
+                worker.wait_ready()
+                worker.connection.send(
+                    ("run", source_hash, None if source_hash in worker.loaded else source, pending)
+                )
+                worker.loaded.add(source_hash)
+                for _ in pending:
+                    if not worker.connection.poll(wall_time):
+                        raise TimeoutError(f"{self.function_name} didn't return within {wall_time}s.")
+                    results.append(worker.connection.recv())
+                    completed += 1
+                worker.calls += completed
+                pending = []
+            except (TimeoutError, EOFError, OSError) as error:
+                # The frame being evaluated hung or took the worker down: report
+                # it as failed and resend the rest of the batch to a new worker.
+                logger.warning(f"Recycling sandbox worker: {error!r}")
+                results.append((False, repr(error)))
+                pending = pending[completed + 1:]
+                worker.kill()
+                worker = None
+            finally:
+                self._release(worker)
+        return results
+
+    def run(self, function_string, metadata_list, wall_time=None):
+        """Evaluate a postprocessor on every frame's metadata.
+
+        Frames are sent to the workers in batches of ``batch_size``, and each
+        may take up to ``wall_time`` seconds, ``self.wall_time`` by default.
+        Returns one ``(ok, value)`` pair per frame, in order, where ``value``
+        is the traceback of the failure when ``ok`` is False.
+        """
+        if self._closed:
+            raise RuntimeError("The sandbox pool is closed.")
+        if wall_time is None:
+            wall_time = self.wall_time
+        source_hash = Executor.source_hash(function_string)
+        batches = [
+            metadata_list[index:index + self.batch_size]
+            for index in range(0, len(metadata_list), self.batch_size)
+        ]
+        futures = [
+            self._dispatcher.submit(self._run_batch, source_hash, function_string, batch, wall_time)
+            for batch in batches
+        ]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    def close(self):
+        """Stop all the workers."""
+        self._closed = True
+        self._dispatcher.shutdown(wait=True)
+        while not self._idle.empty():
+            self._idle.get().stop()
+
+
+if __name__ == "__main__":
+    _worker_loop(Connection(int(sys.argv[1])), sys.argv[2], float(sys.argv[3]), int(sys.argv[4]))
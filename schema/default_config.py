@@ -2,7 +2,7 @@ from dataclasses import (
     dataclass,
     field
 )
-from typing import Any, List, Union 
+from typing import Any, Dict, List, Union 
 
 @dataclass
 class NGCModel:
@@ -24,6 +24,10 @@ class GradioApp:
     server_port: int = 8000  # default port to instantiate the app
     debug: bool = True
     max_file_size: Any = None
+    concurrency_limit: int = 2  # pipelines running at the same time
+    max_queue_size: int = 16  # requests waiting for a pipeline before new ones are refused
+    max_jobs_per_user: int = 2  # requests a user may have waiting or running
+    metrics_port: Union[int, None] = None  # port of the Prometheus /metrics endpoint, None disables it
 
 
 @dataclass
@@ -33,6 +37,130 @@ class NIMConfig:
     api_key: str = "<API_KEY"
 
 
+@dataclass
+class LLMConfig:
+    """Configuration of the LLM prompts."""
+
+    compact_prompt: bool = False  # send a schema and a sample of detections instead of the full metadata
+    prompt_token_budget: int = 1024  # approximate token budget for the detections in the prompt
+    max_prompt_samples: int = 16  # maximum number of sampled detections in a compact prompt
+    num_candidates: int = 1  # postprocessor candidates requested in parallel
+    candidate_temperature: float = 0.6  # sampling temperature of the extra candidates
+    validation_timeout: float = 10.0  # seconds a candidate may run on the first frame
+    max_concurrency: int = 8  # concurrent async LLM calls per event loop
+
+
+@dataclass
+class SandboxConfig:
+    """Configuration of the worker pool running generated code."""
+
+    enabled: bool = False  # run generated postprocessors in sandboxed worker processes
+    workers: int = 2
+    batch_size: int = 16  # frames sent to a worker per message
+    wall_time: float = 5.0  # seconds a single frame may take
+    cpu_time: float = 5.0  # CPU seconds a single frame may use
+    memory_mb: int = 1024  # address space limit of a worker
+    max_calls_per_worker: int = 1000  # frames evaluated before a worker is recycled
+
+
+@dataclass
+class AnalyticsConfig:
+    """Configuration of the per-frame analytics stage."""
+
+    workers: int = 0  # processes analyzing frames in parallel, 0 uses every core
+    mode: str = "frame"  # "frame": one postprocessor call per frame, "video": one call over the whole video, "early_exit": stop once a frame settles the answer
+    chunk_size: int = 8  # frames sent to a process at a time
+    memoize: bool = False  # reuse postprocessor outputs for identical frame metadata
+    quantization: float = 0.0  # coordinate step under which boxes count as identical, 0 for exact matches
+    memo_size: int = 4096  # memoized outputs kept per process
+    early_exit_workers: int = 8  # frames inferred concurrently in early_exit mode
+    frame_order: str = "bisection"  # order of the frames in early_exit mode: "bisection" (coarse to fine) or "sequential"
+    compact_records: bool = False  # hold detections in compact read-only records instead of dictionaries
+
+
+@dataclass
+class CVConfig:
+    """Configuration of the CV inference stages."""
+
+    ocd_mode: str = "eager"  # "eager": OCD on every frame, "auto": skip it when the generated code doesn't read object_text, "lazy": also run it per frame on first read
+    ocd_crops: bool = False  # run OCD on a mosaic of the detected regions instead of the whole frame
+    crop_padding: int = 16  # pixels added around every detected region
+    tracking: bool = False  # track objects across frames and only run OCD on new or moved tracks
+    track_iou_threshold: float = 0.3  # minimum IoU to continue a track
+    text_reuse_iou: float = 0.8  # minimum IoU with the box the text was read from to reuse the text
+    track_max_age: int = 3  # frames a track survives without a detection
+    detection_threshold: float = 0.3  # minimum Grounding DINO confidence of a detection
+    detection_floor_threshold: float = 0.1  # confidence Grounding DINO is queried at, lower detections are never kept
+    detection_cache: bool = False  # keep the raw Grounding DINO responses in the app cache to serve any threshold above the floor
+    detection_cache_max_mb: int = 1024  # size past which the least recently used Grounding DINO cache entries are evicted
+    detection_chunk_cache: bool = False  # keep detections per frame and noun chunk, and only query the noun chunks a frame wasn't queried for
+    inline_max_bytes: int = 180000  # base64 length under which images are sent inline instead of as NVCF assets, 0 always uploads
+
+
+@dataclass
+class EndpointLimitConfig:
+    """Request budget of an upstream endpoint."""
+
+    rate: float = 10.0  # requests started per second
+    burst: int = 16  # requests that may start at once after an idle period
+    max_concurrency: int = 16  # requests in flight once latency has proven healthy, half of it at start
+    min_concurrency: int = 1  # requests in flight under sustained congestion
+    latency_target: float = 10.0  # seconds under which a request counts as healthy
+    decrease: float = 0.5  # factor applied to the concurrency on a 429 or 5xx
+    max_retries: int = 5  # retries of a congested request
+    base_delay: float = 0.5  # seconds of the first backoff, doubled on every retry before jitter
+    max_delay: float = 30.0  # longest backoff in seconds
+
+
+def default_endpoint_limits():
+    """Budgets of the NVCF asset, Grounding DINO, OCD and LLM endpoints."""
+    return {
+        "nvcf_assets": EndpointLimitConfig(rate=20.0, burst=32, max_concurrency=32),
+        "gdino": EndpointLimitConfig(),
+        "ocd": EndpointLimitConfig(),
+        "llm": EndpointLimitConfig(rate=2.0, burst=8, max_concurrency=8, latency_target=60.0)
+    }
+
+
+@dataclass
+class RateLimitConfig:
+    """Request budgets shared by every client of an upstream endpoint."""
+
+    endpoints: Dict[str, EndpointLimitConfig] = field(default_factory=default_endpoint_limits)
+
+
+@dataclass
+class SchedulerConfig:
+    """Configuration of the fair scheduler of the CV and LLM NIM requests."""
+
+    enabled: bool = False  # share the CV and LLM NIM requests fairly between sessions instead of per-request thread pools
+    workers: int = 32  # CV and LLM NIM requests in flight across all sessions
+    quantum: float = 1.0  # requests a session starts per turn
+    urgency: float = 1.0  # seconds before its deadline a request starts ahead of every other
+    image_priority: int = 1  # priority of the image app's requests, higher is served first
+    video_priority: int = 0  # priority of the video app's requests
+    image_deadline: float = 5.0  # seconds an image request should be served in, 0 for no deadline
+
+
+@dataclass
+class ResultsStoreConfig:
+    """Configuration of the store of past video answers."""
+
+    enabled: bool = False  # answer repeated questions on the same video from the store
+    path: str = ""  # directory of the store, defaults to the app cache
+    max_size_mb: int = 10240  # stored videos and stage outputs kept before the least recently used are evicted
+
+
+@dataclass
+class BatchConfig:
+    """Configuration of the headless batch runner."""
+
+    videos: str = ""  # directory of videos, or manifest file listing one video per line
+    questions: str = ""  # file listing one question per line
+    output: str = "batch_results.parquet"  # results table, written as CSV unless it ends in .parquet
+    video_workers: int = 2  # videos processed at the same time
+    sampling_fps: int = 3  # frames extracted per second of video
+
 
 @dataclass
 class GradioApp:
@@ -46,4 +174,12 @@ class GradioApp:
     )
     app: GradioApp = GradioApp()
     nim: NIMConfig = NIMConfig()
+    llm: LLMConfig = field(default_factory=LLMConfig)
+    sandbox: SandboxConfig = field(default_factory=SandboxConfig)
+    analytics: AnalyticsConfig = field(default_factory=AnalyticsConfig)
+    cv: CVConfig = field(default_factory=CVConfig)
+    batch: BatchConfig = field(default_factory=BatchConfig)
+    results_store: ResultsStoreConfig = field(default_factory=ResultsStoreConfig)
+    rate_limits: RateLimitConfig = field(default_factory=RateLimitConfig)
+    scheduler: SchedulerConfig = field(default_factory=SchedulerConfig)
 
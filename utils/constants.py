@@ -7,3 +7,7 @@ URL = "https://integrate.api.nvidia.com/v1"
 
 LOCAL_CACHE = os.getenv("TAO_MM_CACHE", os.path.abspath(os.path.expanduser("~/.cache")))
 APP_CACHE = os.path.join(LOCAL_CACHE, "tao_mm_workflows")
+
+# Columns of a video-level postprocessor input with one entry per frame.
+# The other columns have one entry per detection.
+VIDEO_FRAME_COLUMNS = ("frame_ids", "timestamps")
@@ -0,0 +1,162 @@
+"""Fair sharing of the NIM request workers between concurrent sessions."""
+
+from collections import deque
+from concurrent.futures import Future
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+
+# Session, priority and deadline of the requests made from the current context.
+_session = contextvars.ContextVar("fair_scheduler_session", default=(None, 0, None))
+
+_scheduler = None
+
+
+class _Task:
+    """A submitted call waiting for a worker."""
+
+    __slots__ = ("future", "context", "function", "args", "kwargs", "cost", "taken")
+
+    def __init__(self, function, args, kwargs, cost):
+        """Constructor."""
+        self.future = Future()
+        self.context = contextvars.copy_context()
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.cost = cost
+        self.taken = False
+
+
+class FairScheduler:
+    """Deficit round robin over sessions, with priority classes and deadlines.
+
+    Every session has its own queue. Sessions of the highest priority with
+    pending requests take turns, and a turn starts requests worth up to
+    ``quantum``, so a session with thousands of frames delays a session with
+    a single image by at most one round. Requests less than ``urgency``
+    seconds away from their deadline start before any other, earliest
+    deadline first.
+    """
+
+    def __init__(self, workers=32, quantum=1.0, urgency=1.0):
+        """Constructor."""
+        self.quantum = quantum
+        self.urgency = urgency
+        self._condition = threading.Condition()
+        self._queues = {}  # (priority, session) to its pending tasks
+        self._deficits = {}
+        self._rings = {}  # priority to the sessions taking turns
+        self._deadlines = []  # heap of (deadline, sequence number, task)
+        self._sequence = itertools.count()
+        self._workers = [
+            threading.Thread(target=self._work, name=f"fair-scheduler-{index}", daemon=True)
+            for index in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, function, *args, cost=1.0, **kwargs):
+        """Queue ``function(*args, **kwargs)`` for the current session and return its future.
+
+        The call runs in a copy of the caller's context.
+        """
+        session, priority, deadline = _session.get()
+        task = _Task(function, args, kwargs, cost)
+        key = (priority, session)
+        with self._condition:
+            if key not in self._queues:
+                self._queues[key] = deque()
+                self._deficits[key] = self.quantum
+                self._rings.setdefault(priority, deque()).append(key)
+            self._queues[key].append(task)
+            if deadline is not None:
+                heapq.heappush(self._deadlines, (deadline, next(self._sequence), task))
+            self._condition.notify()
+        return task.future
+
+    def _next_task(self):
+        """Take the next task to run, None if there is none. Called with the lock held."""
+        while self._deadlines and self._deadlines[0][2].taken:
+            heapq.heappop(self._deadlines)
+        if self._deadlines and self._deadlines[0][0] - time.monotonic() <= self.urgency:
+            task = heapq.heappop(self._deadlines)[2]
+            task.taken = True
+            return task
+
+        for priority in sorted(self._rings, reverse=True):
+            ring = self._rings[priority]
+            while ring:
+                key = ring[0]
+                queue = self._queues[key]
+                while queue and queue[0].taken:
+                    queue.popleft()
+                if not queue:
+                    ring.popleft()
+                    del self._queues[key], self._deficits[key]
+                    continue
+                task = queue[0]
+                if self._deficits[key] >= task.cost:
+                    self._deficits[key] -= task.cost
+                    queue.popleft()
+                    task.taken = True
+                    return task
+                ring.rotate(-1)
+                self._deficits[ring[0]] += self.quantum
+            del self._rings[priority]
+        return None
+
+    def _work(self):
+        """Run tasks as they come."""
+        while True:
+            with self._condition:
+                while (task := self._next_task()) is None:
+                    self._condition.wait()
+            if not task.future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = task.context.run(task.function, *task.args, **task.kwargs)
+            except BaseException as error:
+                task.future.set_exception(error)
+            else:
+                task.future.set_result(result)
+
+    def stats(self):
+        """Sessions and requests waiting."""
+        with self._condition:
+            return {
+                "sessions": len(self._queues),
+                "waiting": sum(not task.taken for queue in self._queues.values() for task in queue)
+            }
+
+
+def set_session(session, priority=0, deadline=None):
+    """Make the requests of the current context belong to ``session``.
+
+    Higher priorities are served first. A ``deadline``, in seconds from now,
+    makes the requests jump the queue as it nears.
+    """
+    if deadline is not None:
+        deadline = time.monotonic() + deadline
+    _session.set((session, priority, deadline))
+
+
+def configure(workers=32, quantum=1.0, urgency=1.0):
+    """Start the scheduler shared by every NIM client of the process."""
+    global _scheduler
+    _scheduler = FairScheduler(workers=workers, quantum=quantum, urgency=urgency)
+    return _scheduler
+
+
+def get_scheduler():
+    """The shared scheduler, None if it wasn't started."""
+    return _scheduler
+
+
+def run(function, *args, **kwargs):
+    """Call ``function`` through the shared scheduler if there is one, else directly."""
+    if _scheduler is None:
+        return function(*args, **kwargs)
+    return _scheduler.submit(function, *args, **kwargs).result()
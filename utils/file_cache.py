@@ -0,0 +1,88 @@
+"""Size-bounded LRU directory of cache files."""
+
+import os
+from pathlib import Path
+import threading
+import uuid
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class FileCache:
+    """Files under a directory, such as raw NIM responses, keyed by name.
+
+    Reading a file refreshes its modification time. Once the files exceed
+    ``max_bytes`` the least recently used ones are removed until they fit in
+    ``low_water`` of it, so that eviction doesn't run on every write.
+    """
+
+    def __init__(self, root, max_bytes, low_water=0.9):
+        """Constructor."""
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        """``(last_used, size, path)`` of the cached files, least recently used first."""
+        entries = []
+        for path in self.root.rglob("*"):
+            if path.name.endswith(".tmp"):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if path.is_file():
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def get(self, name):
+        """Content of a cached file, None on a miss."""
+        path = self.root / name
+        try:
+            content = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return content
+
+    def put(self, name, content):
+        """Cache a file so that readers never see it half written, evicting the least recently used ones."""
+        path = self.root / name
+        os.makedirs(path.parent, exist_ok=True)
+        temp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        temp_path.write_bytes(content)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._size += len(content)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Remove the least recently used files. Called with the lock held."""
+        entries = self._entries()
+        # Recounted from the directory, which other processes may also write to.
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= self.max_bytes * self.low_water:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            self._size -= size
+
+
+def get_file_cache(root, max_bytes):
+    """Cache of a directory, shared by all its clients in the process."""
+    root = os.path.abspath(root)
+    with _caches_lock:
+        if root not in _caches:
+            _caches[root] = FileCache(root, max_bytes)
+        cache = _caches[root]
+        cache.max_bytes = max_bytes
+        return cache
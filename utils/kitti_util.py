@@ -1,10 +1,14 @@
 import ast
+import copy
 import os
 import csv
+import threading
 import cv2
 from shapely.geometry import Polygon, box 
 from pathlib import Path 
 
+from utils.records import Detection, TextRegion
+
 def _polygon_intersection(polygon_dict, bbox):
     polygon_points = []
     for key in polygon_dict.keys():
@@ -19,8 +23,106 @@ def _polygon_intersection(polygon_dict, bbox):
 
     return polygon.intersects(bbox)
 
-def read_kitti(kitti_file, ocd_data=None):
-    """Function to read the KITTI dataset."""
+def associate_text(ocd_data, bbox):
+    """Join the OCD labels whose polygon intersects the box."""
+    object_str = ""
+    for ocd in ocd_data["metadata"]:
+        if isinstance(ocd, TextRegion):
+            if ocd.shape.intersects(box(*bbox)):
+                object_str = object_str + " " + ocd.label
+        elif _polygon_intersection(ocd["polygon"], bbox):
+            object_str = object_str + " " + (ocd["label"])
+    return object_str
+
+
+class LazyFrameText:
+    """OCD results of a frame, loaded the first time a detection reads its text."""
+
+    def __init__(self, load_ocd_data):
+        """Constructor taking a callable that returns the frame's OCD data."""
+        self._load_ocd_data = load_ocd_data
+        self._ocd_data = None
+        self._lock = threading.Lock()
+
+    def text_for(self, bbox):
+        """Text inside a box, running OCD on the frame if it hasn't run yet."""
+        with self._lock:
+            if self._ocd_data is None:
+                self._ocd_data = self._load_ocd_data()
+        return associate_text(self._ocd_data, bbox)
+
+    def __getstate__(self):
+        # Pickles hold the OCD results if they were loaded, else the loader.
+        with self._lock:
+            loaded = self._ocd_data is not None
+            return {"load_ocd_data": None if loaded else self._load_ocd_data, "ocd_data": self._ocd_data}
+
+    def __setstate__(self, state):
+        self._load_ocd_data = state["load_ocd_data"]
+        self._ocd_data = state["ocd_data"]
+        self._lock = threading.Lock()
+
+
+class LazyTextDetection(dict):
+    """Detection whose object_text is only computed when it is read."""
+
+    def __init__(self, detection, frame_text):
+        """Constructor."""
+        super().__init__(detection)
+        self._frame_text = frame_text
+
+    def __missing__(self, key):
+        if key != "object_text":
+            raise KeyError(key)
+        value = self._frame_text.text_for(self["bbox"])
+        self["object_text"] = value
+        return value
+
+    def __contains__(self, key):
+        return key == "object_text" or super().__contains__(key)
+
+    def get(self, key, default=None):
+        if key == "object_text":
+            return self["object_text"]
+        return super().get(key, default)
+
+    def __deepcopy__(self, memo):
+        # Copies share the frame's OCD results.
+        return LazyTextDetection(copy.deepcopy(dict(self), memo), self._frame_text)
+
+
+def make_detection(class_name, bbox, confidence, ocd_data=None, frame_text=None, records=False):
+    """Build the metadata of one detection and associate the OCD text with it."""
+    if records:
+        return Detection(
+            class_name,
+            bbox,
+            confidence,
+            object_text=associate_text(ocd_data, bbox) if ocd_data else None,
+            frame_text=frame_text
+        )
+    detection = {
+        "class_name": class_name,
+        "bbox": bbox,
+        "confidence": confidence
+    }
+
+    #if ocd data then correlate it with the object and add to metadata 
+    if ocd_data:
+        """Add ocd field to metadata"""
+        detection["object_text"] = associate_text(ocd_data, bbox)
+    elif frame_text is not None:
+        detection = LazyTextDetection(detection, frame_text)
+    return detection
+
+def read_kitti(kitti_file, ocd_data=None, frame_text=None, records=False, min_confidence=None):
+    """Function to read the KITTI dataset.
+
+    With a ``LazyFrameText`` the object_text of a detection is only computed
+    when the detection's text is read. With ``records`` the detections are
+    compact read-only ``Detection`` records instead of dictionaries. With a
+    ``min_confidence`` the detections scored under it are skipped.
+    """
     if not os.path.exists(kitti_file):
         raise FileNotFoundError(f"Kitti file not found at {kitti_file}.")
     object_list = []
@@ -29,26 +131,68 @@ def read_kitti(kitti_file, ocd_data=None):
         for row in csv_reader:
             assert len(row) >= 15, "Atleast 15 elements are needed in the KITTI file."
             metadata = row[-15:]
+            confidence = float(metadata[-1])
+            if min_confidence is not None and confidence < min_confidence:
+                continue
             object_bbox = [ast.literal_eval(coordinate) for coordinate in metadata[3:7]]
-            object_list.append(
-                {
-                    "class_name": " ".join(row[:-15]),
-                    "bbox": object_bbox,
-                    "confidence": float(metadata[-1])
-                }
-            )
-
-            #if ocd data then correlate it with the object and add to metadata 
-            if ocd_data:
-                object_str = ""
-                """Add ocd field to metadata"""
-                for ocd in ocd_data["metadata"]:
-                    if _polygon_intersection(ocd["polygon"], object_bbox):
-                        object_str = object_str + " " + (ocd["label"])
-                object_list[-1]["object_text"] = object_str
+            object_list.append(make_detection(
+                " ".join(row[:-15]),
+                object_bbox,
+                confidence,
+                ocd_data=ocd_data,
+                frame_text=frame_text,
+                records=records
+            ))
 
     return object_list
 
+def build_video_columns(frame_metadata, frame_ids, fps):
+    """Flatten the detections of every frame into columns for a video-level postprocessor."""
+    fields = []
+    for metadata in frame_metadata:
+        for detection in metadata:
+            for key in detection:
+                if key not in fields:
+                    fields.append(key)
+
+    video = {
+        "frame_ids": list(frame_ids),
+        "timestamps": [index / fps for index in range(len(frame_ids))],
+        "frame_index": [],
+        "timestamp": []
+    }
+    video.update({key: [] for key in fields})
+    for index, metadata in enumerate(frame_metadata):
+        for detection in metadata:
+            video["frame_index"].append(index)
+            video["timestamp"].append(index / fps)
+            for key in fields:
+                video[key].append(detection.get(key))
+    return video
+
+def overlay_label_on_image(image_path: str, label_path: str, output_path: str, kitti_file: str=None):
+    """Draw a frame's detections and analytics label and save the annotated frame."""
+    # Load image
+    image = cv2.imread(image_path)
+
+    #load detections
+    if kitti_file:
+        detection_metadata = read_kitti(kitti_file, ocd_data=None)
+        for object in detection_metadata:
+            bbox = object["bbox"]
+            cv2.rectangle(image, (int(bbox[0]), int(bbox[1])), (int(bbox[2]), int(bbox[3])), (0,255,0), 2)
+
+    # Load label file
+    with open(label_path, "r") as f:
+        label = f.read().strip()
+    
+    # Overlay label onto image
+    cv2.putText(image, label, (200, 200), cv2.FONT_HERSHEY_SIMPLEX, 5, (0, 0, 255), 5)
+    
+    # Save annotated image
+    cv2.imwrite(output_path, image)
+    return output_path
+
 def overlay_labels_on_images(images_dir: str, labels_dir: str, output_dir: str, detection_dir:str=None):
     # Create output directory if it doesn't exist
     if not os.path.exists(output_dir):
@@ -59,28 +203,15 @@ def overlay_labels_on_images(images_dir: str, labels_dir: str, output_dir: str,
     
     # Iterate over image files
     for image_file in image_files:
-        # Load image
-        image_path = os.path.join(images_dir, image_file)
-        image = cv2.imread(image_path)
+        # Frames that weren't analyzed aren't rendered
+        label_file = os.path.splitext(image_file)[0] + ".txt"
+        label_path = os.path.join(labels_dir, label_file)
+        if not os.path.exists(label_path):
+            continue
 
-        #load detections
+        kitti_file = None
         if detection_dir:
             kitti_file = os.path.join(detection_dir, Path(image_file).with_suffix(".txt"))
-            detection_metadata = read_kitti(kitti_file, ocd_data=None)
-            for object in detection_metadata:
-                bbox = object["bbox"]
-                cv2.rectangle(image, (int(bbox[0]), int(bbox[1])), (int(bbox[2]), int(bbox[3])), (0,255,0), 2)
-
-        
-        # Load label file
-        label_file = os.path.splitext(image_file)[0] + ".txt"
-        label_path = os.path.join(labels_dir, label_file)
-        with open(label_path, "r") as f:
-            label = f.read().strip()
-        
-        # Overlay label onto image
-        cv2.putText(image, label, (200, 200), cv2.FONT_HERSHEY_SIMPLEX, 5, (0, 0, 255), 5)
-        
-        # Save annotated image
-        output_path = os.path.join(output_dir, image_file)
-        cv2.imwrite(output_path, image)
+        overlay_label_on_image(
+            os.path.join(images_dir, image_file), label_path, os.path.join(output_dir, image_file), kitti_file
+        )
@@ -0,0 +1,104 @@
+"""Pack the detected regions of a frame into a single mosaic image."""
+
+from PIL import Image
+
+# Blank pixels between tiles, so text never runs from one crop into the next.
+TILE_SPACING = 4
+
+
+def pad_boxes(boxes, padding, width, height):
+    """Grow boxes by ``padding`` pixels and clip them to the frame."""
+    padded = []
+    for xmin, ymin, xmax, ymax in boxes:
+        padded.append((
+            max(0, int(xmin) - padding),
+            max(0, int(ymin) - padding),
+            min(width, int(round(xmax)) + padding),
+            min(height, int(round(ymax)) + padding)
+        ))
+    return [box for box in padded if box[2] > box[0] and box[3] > box[1]]
+
+
+def merge_boxes(boxes):
+    """Merge overlapping boxes until none overlap, so no region is cropped twice."""
+    merged = list(boxes)
+    changed = True
+    while changed:
+        changed = False
+        result = []
+        for box in merged:
+            for index, other in enumerate(result):
+                if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]:
+                    result[index] = (
+                        min(box[0], other[0]), min(box[1], other[1]),
+                        max(box[2], other[2]), max(box[3], other[3])
+                    )
+                    changed = True
+                    break
+            else:
+                result.append(box)
+        merged = result
+    return merged
+
+
+def pack_tiles(sizes, max_width):
+    """Shelf pack tiles of the given (width, height) into rows of ``max_width``.
+
+    Returns the (x, y) position of every tile and the size of the mosaic.
+    """
+    order = sorted(range(len(sizes)), key=lambda index: -sizes[index][1])
+    positions = [None] * len(sizes)
+    x = y = shelf_height = used_width = 0
+    for index in order:
+        width, height = sizes[index]
+        if x and x + width > max_width:
+            x = 0
+            y += shelf_height + TILE_SPACING
+            shelf_height = 0
+        positions[index] = (x, y)
+        used_width = max(used_width, x + width)
+        x += width + TILE_SPACING
+        shelf_height = max(shelf_height, height)
+    return positions, (used_width, y + shelf_height)
+
+
+def build_mosaic(image, boxes, padding=16):
+    """Crop the padded boxes out of an image and pack them into a mosaic.
+
+    Returns the mosaic and its tiles as ``(x, y, frame_box)``, where (x, y) is
+    the tile position in the mosaic and ``frame_box`` the region it was cut
+    from. Returns None when the mosaic wouldn't be smaller than the image.
+    """
+    regions = merge_boxes(pad_boxes(boxes, padding, image.width, image.height))
+    if not regions:
+        return None
+    sizes = [(xmax - xmin, ymax - ymin) for xmin, ymin, xmax, ymax in regions]
+    positions, (width, height) = pack_tiles(sizes, image.width)
+    if width * height >= image.width * image.height:
+        return None
+
+    mosaic = Image.new("RGB", (width, height))
+    tiles = []
+    for (x, y), region in zip(positions, regions):
+        mosaic.paste(image.crop(region), (x, y))
+        tiles.append((x, y, region))
+    return mosaic, tiles
+
+
+def map_polygon_to_frame(polygon, tiles):
+    """Move a polygon detected on the mosaic back to frame coordinates.
+
+    The polygon is assigned to the tile holding its centroid. Returns None
+    when the centroid falls between tiles.
+    """
+    xs = [value for key, value in polygon.items() if key.startswith("x")]
+    ys = [value for key, value in polygon.items() if key.startswith("y")]
+    centroid_x = sum(xs) / len(xs)
+    centroid_y = sum(ys) / len(ys)
+    for x, y, (xmin, ymin, xmax, ymax) in tiles:
+        if x <= centroid_x < x + xmax - xmin and y <= centroid_y < y + ymax - ymin:
+            return {
+                key: value + (xmin - x if key.startswith("x") else ymin - y)
+                for key, value in polygon.items()
+            }
+    return None
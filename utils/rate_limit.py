@@ -0,0 +1,208 @@
+"""Request rate and concurrency limits shared by every client of an upstream endpoint."""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Responses that mean the endpoint is over its quota or struggling.
+RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+# Seconds between checks for a free slot.
+POLL_INTERVAL = 0.05
+
+
+def _retry_after(headers):
+    """Seconds asked for by a Retry-After header, None if there is none."""
+    try:
+        return max(0.0, float(headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_congestion(error, retry_errors=()):
+    """Whether an exception raised by a client is worth a retry."""
+    return getattr(error, "status_code", None) in RETRY_STATUS or \
+        isinstance(error, (ConnectionError, TimeoutError) + tuple(retry_errors))
+
+
+class EndpointLimiter:
+    """Token bucket and adaptive concurrency limit of one upstream endpoint.
+
+    Requests are started at most ``rate`` per second, in bursts of up to
+    ``burst``. The number of requests in flight starts at half of
+    ``max_concurrency``, grows by one every time as many requests as the
+    current limit completed within ``latency_target`` seconds, and is cut by
+    ``decrease`` on a 429, a 5xx or a connection error. Those are retried up
+    to ``max_retries`` times after a jittered exponential backoff, or after
+    the Retry-After delay, during which no new request starts.
+    """
+
+    def __init__(self, name, rate=10.0, burst=16, max_concurrency=16, min_concurrency=1,
+                 latency_target=10.0, decrease=0.5, max_retries=5, base_delay=0.5, max_delay=30.0):
+        """Constructor."""
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.latency_target = latency_target
+        self.decrease = decrease
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.concurrency = float(max(min_concurrency, max_concurrency // 2))
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._in_flight = 0
+        self._successes = 0
+        self._paused_until = 0.0
+
+    def _try_acquire(self):
+        """Take a slot and a token. Returns 0 on success, else the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self._in_flight >= int(self.concurrency):
+                return POLL_INTERVAL
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            self._tokens -= 1
+            self._in_flight += 1
+            return 0
+
+    def acquire(self):
+        """Wait for a slot and a token."""
+        while (wait := self._try_acquire()) > 0:
+            time.sleep(wait)
+
+    async def aacquire(self):
+        """Wait for a slot and a token without blocking the event loop."""
+        while (wait := self._try_acquire()) > 0:
+            await asyncio.sleep(wait)
+
+    def release(self, latency=None, congested=False, retry_after=None):
+        """Free a slot and adapt the concurrency to how the request went."""
+        with self._lock:
+            self._in_flight -= 1
+            if congested:
+                self.concurrency = max(self.min_concurrency, self.concurrency * self.decrease)
+                self._successes = 0
+                if retry_after:
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            elif latency is not None and latency <= self.latency_target:
+                self._successes += 1
+                if self._successes >= int(self.concurrency):
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                    self._successes = 0
+
+    def backoff(self, attempt, retry_after=None):
+        """Seconds to wait before retrying, the Retry-After delay if there is one."""
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def request(self, method, url, **kwargs):
+        """Send an HTTP request with ``requests`` within the limits, retrying congestion.
+
+        Returns the last response, which may still be an error status.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            start = time.monotonic()
+            try:
+                response = requests.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.release(congested=True)
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+            else:
+                congested = response.status_code in RETRY_STATUS
+                retry_after = _retry_after(response.headers) if congested else None
+                self.release(time.monotonic() - start, congested, retry_after)
+                if not congested or attempt == self.max_retries:
+                    return response
+                delay = self.backoff(attempt, retry_after)
+            logger.info(f"{self.name} is congested, retrying in {delay:.2f}s.")
+            time.sleep(delay)
+
+    def call(self, function, *args, retry_errors=(), **kwargs):
+        """Run a client call within the limits, retrying the errors that signal congestion.
+
+        Errors with a retryable ``status_code``, connection errors and
+        ``retry_errors`` count as congestion.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            start = time.monotonic()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                congested = _is_congestion(error, retry_errors)
+                self.release(congested=congested)
+                if not congested or attempt == self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+            except BaseException:
+                self.release()
+                raise
+            else:
+                self.release(time.monotonic() - start)
+                return result
+            logger.info(f"{self.name} is congested, retrying in {delay:.2f}s.")
+            time.sleep(delay)
+
+    async def acall(self, function, *args, retry_errors=(), **kwargs):
+        """Await a client coroutine function within the limits, retrying congestion like ``call``."""
+        for attempt in range(self.max_retries + 1):
+            await self.aacquire()
+            start = time.monotonic()
+            try:
+                result = await function(*args, **kwargs)
+            except Exception as error:
+                congested = _is_congestion(error, retry_errors)
+                self.release(congested=congested)
+                if not congested or attempt == self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+            except BaseException:
+                self.release()
+                raise
+            else:
+                self.release(time.monotonic() - start)
+                return result
+            logger.info(f"{self.name} is congested, retrying in {delay:.2f}s.")
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        """Current concurrency limit and requests in flight."""
+        with self._lock:
+            return {"concurrency": int(self.concurrency), "in_flight": self._in_flight}
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def configure(endpoints):
+    """Set the limits of the endpoints from a mapping of endpoint name to limiter options."""
+    with _limiters_lock:
+        for name, options in endpoints.items():
+            _limiters[name] = EndpointLimiter(name, **options)
+
+
+def limiter(name):
+    """Limiter shared by every client of an endpoint, with the default limits if it isn't configured."""
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = EndpointLimiter(name)
+        return _limiters[name]
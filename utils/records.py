@@ -0,0 +1,121 @@
+"""Compact records for detections and OCD text regions."""
+
+from collections.abc import Mapping
+import copy
+import sys
+
+from shapely.geometry import Polygon
+
+
+class Detection(Mapping):
+    """Read-only mapping view of a single detection.
+
+    Fields live in slots instead of a per-object dictionary, and the class
+    names are interned, so frames with many detections stay small. Optional
+    fields are only present once set. With a ``frame_text`` the object_text
+    is computed the first time it is read.
+    """
+
+    __slots__ = ("class_name", "bbox", "confidence", "object_text", "track_id", "frame_text")
+
+    FIELDS = ("class_name", "bbox", "confidence", "object_text", "track_id")
+
+    def __init__(self, class_name, bbox, confidence, object_text=None, track_id=None, frame_text=None):
+        """Constructor."""
+        self.class_name = sys.intern(class_name)
+        self.bbox = list(bbox)
+        self.confidence = confidence
+        self.object_text = object_text
+        self.track_id = track_id
+        self.frame_text = frame_text
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        value = getattr(self, key)
+        if value is None and key == "object_text" and self.frame_text is not None:
+            value = self.object_text = self.frame_text.text_for(self.bbox)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        if key not in self.FIELDS:
+            return False
+        return getattr(self, key) is not None or (key == "object_text" and self.frame_text is not None)
+
+    def __iter__(self):
+        return (key for key in self.FIELDS if key in self)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def __reduce__(self):
+        # Pickles carry the frame's text source until the text was read, so
+        # that sending a record to another process doesn't run OCD.
+        frame_text = self.frame_text if self.object_text is None else None
+        return (
+            Detection,
+            (self.class_name, self.bbox, self.confidence, self.object_text, self.track_id, frame_text)
+        )
+
+    def __deepcopy__(self, memo):
+        # Copies share the frame's OCD results.
+        return Detection(
+            self.class_name, copy.deepcopy(self.bbox, memo), self.confidence,
+            self.object_text, self.track_id, self.frame_text
+        )
+
+    def to_dict(self):
+        """Plain dictionary with the fields of the detection."""
+        return {key: self[key] for key in self}
+
+
+class TextRegion:
+    """Text label found by OCD and the polygon around it."""
+
+    __slots__ = ("label", "points", "_shape")
+
+    def __init__(self, label, points):
+        """Constructor taking the label and the (x, y) vertices of its polygon."""
+        self.label = label
+        self.points = tuple(points)
+        self._shape = None
+
+    @classmethod
+    def from_ocd(cls, entry):
+        """Build a region from an entry of the OCD response."""
+        polygon = entry["polygon"]
+        points = [
+            (polygon[key], polygon[key.replace("x", "y")]) for key in polygon if key.startswith("x")
+        ]
+        return cls(entry["label"], points)
+
+    @property
+    def shape(self):
+        """Shapely polygon of the region, built once."""
+        if self._shape is None:
+            self._shape = Polygon(self.points)
+        return self._shape
+
+    def __reduce__(self):
+        return (TextRegion, (self.label, self.points))
+
+    def to_dict(self):
+        """Dictionary in the layout of the OCD response."""
+        polygon = {}
+        for index, (x, y) in enumerate(self.points, start=1):
+            polygon[f"x{index}"] = x
+            polygon[f"y{index}"] = y
+        return {"label": self.label, "polygon": polygon}
+
+
+def set_field(detection, key, value):
+    """Set a field of a detection, whether it is a record or a dictionary."""
+    if isinstance(detection, Detection):
+        setattr(detection, key, value)
+    else:
+        detection[key] = value
@@ -0,0 +1,35 @@
+"""Bounded LRU cache of computed results."""
+
+from collections import OrderedDict
+import copy
+import threading
+
+
+class ResultCache:
+    """Bounded LRU of results, such as postprocessor outputs or detections, keyed by a hash."""
+
+    def __init__(self, max_entries=4096):
+        """Constructor."""
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return ``(found, value)`` for a key."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, copy.deepcopy(self._entries[key])
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used entries."""
+        with self._lock:
+            self._entries[key] = copy.deepcopy(value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
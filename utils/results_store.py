@@ -0,0 +1,229 @@
+"""SQLite store of past video answers and of the stage outputs they came from."""
+
+from collections import Counter
+import hashlib
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+from utils.singleflight import fingerprint
+
+
+def file_hash(path, block_size=1 << 20):
+    """SHA-256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def normalize_question(question):
+    """Question with its case, spacing and final punctuation ignored."""
+    return re.sub(r"\s+", " ", question.strip().lower()).rstrip("?.! ")
+
+
+def path_size(path):
+    """Bytes used by a file or by everything under a directory."""
+    path = Path(path)
+    if path.is_file():
+        return path.stat().st_size
+    return sum(child.stat().st_size for child in path.rglob("*") if child.is_file())
+
+
+def _remove(path):
+    """Remove a file or a directory, if it is still there."""
+    path = Path(path)
+    if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    elif path.exists():
+        path.unlink()
+
+
+class ResultsStore:
+    """Answers keyed by video content, sampling parameters and normalized question.
+
+    An answer holds the per-frame results, the answer for the whole video and
+    the rendered video. Stage outputs, such as the extracted frames, are kept
+    per video and parameters so that a new question on a known video resumes
+    after them. Once the stored files exceed ``max_bytes`` the least recently
+    used entries are evicted, except the stage outputs pinned by a run of
+    this process.
+    """
+
+    def __init__(self, root, max_bytes):
+        """Constructor."""
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        os.makedirs(self.root / "answers", exist_ok=True)
+        os.makedirs(self.root / "artifacts", exist_ok=True)
+        self._lock = threading.Lock()
+        self._pins = Counter()  # artifact keys to the runs using them
+        # Files left behind by runs that were interrupted while moving them.
+        for leftover in [*self.root.glob("*/*.tmp"), *self.root.glob("*/*.old"), *self.root.glob("*/*.evicted")]:
+            _remove(leftover)
+        self._db = sqlite3.connect(str(self.root / "results.db"), check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                " key TEXT PRIMARY KEY, frame_results TEXT, video_answer TEXT,"
+                " video_path TEXT, size INTEGER, last_used REAL);"
+                "CREATE TABLE IF NOT EXISTS artifacts ("
+                " key TEXT PRIMARY KEY, path TEXT, size INTEGER, last_used REAL);"
+            )
+
+    @staticmethod
+    def answer_key(video_hash, params, question):
+        """Key of the answer to a question on a video sampled with ``params``."""
+        return fingerprint(video_hash, params, normalize_question(question))
+
+    @staticmethod
+    def artifact_key(video_hash, params, stage):
+        """Key of the output of a stage on a video sampled with ``params``."""
+        return fingerprint(video_hash, params, stage)
+
+    def get_answer(self, video_hash, params, question):
+        """Stored answer as a dictionary, None if there is none."""
+        key = self.answer_key(video_hash, params, question)
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT frame_results, video_answer, video_path FROM answers WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            frame_results, video_answer, video_path = row
+            if not os.path.exists(video_path):
+                self._db.execute("DELETE FROM answers WHERE key = ?", (key,))
+                return None
+            self._db.execute("UPDATE answers SET last_used = ? WHERE key = ?", (time.time(), key))
+        return {
+            "frame_results": json.loads(frame_results),
+            "video_answer": json.loads(video_answer),
+            "video_path": video_path
+        }
+
+    def put_answer(self, video_hash, params, question, frame_results, video_answer, video_file):
+        """Store an answer and a copy of its rendered video. Returns the stored video's path.
+
+        ``frame_results`` maps frame ids to their results. Results and answer
+        are stored as strings.
+        """
+        key = self.answer_key(video_hash, params, question)
+        video_path = self.root / "answers" / (key + Path(video_file).suffix)
+        temp_path = video_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        shutil.copyfile(video_file, temp_path)
+        os.replace(temp_path, video_path)
+        frame_results = {frame_id: str(result) for frame_id, result in frame_results.items()}
+        video_answer = None if video_answer is None else str(video_answer)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?)",
+                (key, json.dumps(frame_results), json.dumps(video_answer), str(video_path),
+                 path_size(video_path), time.time())
+            )
+        self._evict()
+        return str(video_path)
+
+    def get_artifact(self, video_hash, params, stage, pin=False):
+        """Directory of a stored stage output, None if there is none.
+
+        With ``pin`` the output isn't evicted until it is released.
+        """
+        key = self.artifact_key(video_hash, params, stage)
+        with self._lock, self._db:
+            row = self._db.execute("SELECT path FROM artifacts WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if not os.path.exists(row[0]):
+                self._db.execute("DELETE FROM artifacts WHERE key = ?", (key,))
+                return None
+            self._db.execute("UPDATE artifacts SET last_used = ? WHERE key = ?", (time.time(), key))
+            if pin:
+                self._pins[key] += 1
+        return row[0]
+
+    def release(self, video_hash, params, stage):
+        """Unpin a stage output pinned by ``get_artifact`` or ``put_artifact``."""
+        key = self.artifact_key(video_hash, params, stage)
+        with self._lock:
+            self._pins[key] -= 1
+            if self._pins[key] <= 0:
+                del self._pins[key]
+        self._evict()
+
+    def copy_artifact(self, video_hash, params, stage, destination):
+        """Copy a stored stage output into ``destination``. Returns whether there was one."""
+        source = self.get_artifact(video_hash, params, stage, pin=True)
+        if source is None:
+            return False
+        try:
+            shutil.copytree(source, destination, dirs_exist_ok=True)
+        finally:
+            self.release(video_hash, params, stage)
+        return True
+
+    def put_artifact(self, video_hash, params, stage, source, pin=False, replace=False):
+        """Store a stage output directory, moving it into the store. Returns its stored path.
+
+        If the output is already stored, ``source`` is removed and the stored
+        copy is kept, unless ``replace`` is set and no run is using it. With
+        ``pin`` the output isn't evicted until it is released.
+        """
+        key = self.artifact_key(video_hash, params, stage)
+        path = self.root / "artifacts" / key
+        # Moved next to its final place first, so that it appears there at once.
+        staging = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        shutil.move(source, staging)
+        size = path_size(staging)
+        discarded = None
+        with self._lock, self._db:
+            if path.exists() and replace and not self._pins[key]:
+                discarded = path.with_suffix(f".{uuid.uuid4().hex}.old")
+                os.rename(path, discarded)
+            if path.exists():
+                discarded = staging
+                size = path_size(path)
+            else:
+                os.rename(staging, path)
+            self._db.execute(
+                "INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?)",
+                (key, str(path), size, time.time())
+            )
+            if pin:
+                self._pins[key] += 1
+        if discarded is not None:
+            _remove(discarded)
+        self._evict()
+        return str(path)
+
+    def _evict(self):
+        """Remove the least recently used entries until the store fits in ``max_bytes``."""
+        with self._lock, self._db:
+            entries = self._db.execute(
+                "SELECT 'answers', key, video_path, size, last_used FROM answers "
+                "UNION ALL SELECT 'artifacts', key, path, size, last_used FROM artifacts "
+                "ORDER BY last_used"
+            ).fetchall()
+            total = sum(size for _, _, _, size, _ in entries)
+            evicted = []
+            for table, key, path, size, _ in entries:
+                if total <= self.max_bytes:
+                    break
+                if table == "artifacts" and self._pins[key]:
+                    continue
+                self._db.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+                total -= size
+                if os.path.exists(path):
+                    # Moved aside at once, so that a copy stored again under
+                    # the same path isn't removed with it.
+                    trash = f"{path}.{uuid.uuid4().hex}.evicted"
+                    os.rename(path, trash)
+                    evicted.append(trash)
+        for path in evicted:
+            _remove(path)
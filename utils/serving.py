@@ -0,0 +1,116 @@
+"""Admission control for the pipelines served by the gradio apps."""
+
+from collections import defaultdict, deque
+import itertools
+import threading
+
+
+class Overloaded(Exception):
+    """Raised when a job is refused because the queue or a user's quota is full."""
+
+
+class JobQueue:
+    """First come, first served queue running a bounded number of jobs at once.
+
+    Jobs beyond ``concurrency`` wait in order. A job is refused when
+    ``max_queue_size`` jobs are already waiting or when its user already has
+    ``max_jobs_per_user`` jobs waiting or running.
+    """
+
+    def __init__(self, concurrency=2, max_queue_size=16, max_jobs_per_user=2):
+        """Constructor."""
+        self.concurrency = concurrency
+        self.max_queue_size = max_queue_size
+        self.max_jobs_per_user = max_jobs_per_user
+        self._condition = threading.Condition()
+        self._tickets = itertools.count()
+        self._waiting = deque()
+        self._running = 0
+        self._jobs_per_user = defaultdict(int)
+
+    def _admit(self, user):
+        """Register a job and return its ticket, or raise if it can't be queued."""
+        with self._condition:
+            if len(self._waiting) >= self.max_queue_size:
+                raise Overloaded("The server is busy, please try again later.")
+            if self._jobs_per_user[user] >= self.max_jobs_per_user:
+                raise Overloaded(f"At most {self.max_jobs_per_user} requests per user can be queued.")
+            ticket = next(self._tickets)
+            self._waiting.append(ticket)
+            self._jobs_per_user[user] += 1
+            return ticket
+
+    def _wait_turn(self, ticket, on_wait=None):
+        """Block until the job is first in line and a slot is free."""
+        reported = None
+        while True:
+            with self._condition:
+                if self._waiting[0] == ticket and self._running < self.concurrency:
+                    self._waiting.popleft()
+                    self._running += 1
+                    self._condition.notify_all()
+                    return
+                position = self._waiting.index(ticket) + 1
+                if position == reported:
+                    self._condition.wait(timeout=1.0)
+                    continue
+            reported = position
+            if on_wait is not None:
+                on_wait(position)
+
+    def _finish(self, ticket, user, started):
+        """Release the job's slot and its user's quota."""
+        with self._condition:
+            if started:
+                self._running -= 1
+            elif ticket in self._waiting:
+                self._waiting.remove(ticket)
+            self._jobs_per_user[user] -= 1
+            if not self._jobs_per_user[user]:
+                del self._jobs_per_user[user]
+            self._condition.notify_all()
+
+    def run(self, user, function, *args, on_wait=None, **kwargs):
+        """Queue ``function(*args, **kwargs)`` for ``user`` and return its result.
+
+        ``on_wait(position)`` is called whenever the job's 1-based position in
+        the queue changes while it waits.
+        """
+        ticket = self._admit(user)
+        started = False
+        try:
+            self._wait_turn(ticket, on_wait)
+            started = True
+            return function(*args, **kwargs)
+        finally:
+            self._finish(ticket, user, started)
+
+    def stream(self, user, function, *args, on_wait=None, **kwargs):
+        """Like ``run`` for a generator function, yielding its values.
+
+        The job holds its slot until the generator is exhausted or closed.
+        """
+        ticket = self._admit(user)
+        started = False
+        try:
+            self._wait_turn(ticket, on_wait)
+            started = True
+            yield from function(*args, **kwargs)
+        finally:
+            self._finish(ticket, user, started)
+
+    def stats(self):
+        """Jobs waiting and running."""
+        with self._condition:
+            return {"waiting": len(self._waiting), "running": self._running}
+
+
+def request_user(request):
+    """Identify the user of a gradio request: its login if any, else its client address."""
+    if request is None:
+        return None
+    username = getattr(request, "username", None)
+    if username:
+        return username
+    client = getattr(request, "client", None)
+    return getattr(client, "host", None) or getattr(request, "session_hash", None)
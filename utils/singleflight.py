@@ -0,0 +1,98 @@
+"""Coalesce identical concurrent requests into a single upstream call."""
+
+import asyncio
+from concurrent.futures import Future
+import copy
+import hashlib
+import json
+import threading
+
+
+def fingerprint(*parts):
+    """Stable hash of the parts of a request.
+
+    Bytes are hashed as is, everything else as sorted JSON.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, (bytes, bytearray)):
+            data = bytes(part)
+        else:
+            data = json.dumps(part, sort_keys=True, default=str).encode("utf-8")
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class SingleFlight:
+    """Share one in-flight call between all concurrent callers of the same key.
+
+    The first caller of a key runs the call, the other callers wait for it and
+    receive a copy of its result or its exception. Once the call finishes the
+    key is released, so results are never cached beyond the call itself.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+
+    def do(self, key, function, *args, **kwargs):
+        """Run ``function`` once for all threads concurrently calling ``key``."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+        if not leader:
+            return copy.deepcopy(future.result())
+
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    async def ado(self, key, coroutine_function, *args, **kwargs):
+        """Await ``coroutine_function`` once for all tasks concurrently calling ``key``.
+
+        Cancelling a waiter only detaches it. The shared call is cancelled once
+        every waiter is gone.
+        """
+        loop = asyncio.get_running_loop()
+        task_key = (id(loop), key)
+        with self._lock:
+            entry = self._tasks.get(task_key)
+            leader = entry is None
+            if leader:
+                task = loop.create_task(coroutine_function(*args, **kwargs))
+                entry = self._tasks[task_key] = {"task": task, "waiters": 0}
+                task.add_done_callback(
+                    lambda _, entry=entry: self._release(task_key, entry)
+                )
+            entry["waiters"] += 1
+
+        task = entry["task"]
+        try:
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if entry["waiters"] == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            entry["waiters"] -= 1
+        return result if leader else copy.deepcopy(result)
+
+    def _release(self, task_key, entry):
+        """Forget a finished shared task."""
+        with self._lock:
+            if self._tasks.get(task_key) is entry:
+                del self._tasks[task_key]
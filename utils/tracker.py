@@ -0,0 +1,114 @@
+"""IoU and centroid tracking of detections across consecutive frames."""
+
+import itertools
+
+import numpy as np
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """Pairwise IoU of two arrays of (xmin, ymin, xmax, ymax) boxes."""
+    boxes_a = np.asarray(boxes_a, dtype=float).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=float).reshape(-1, 4)
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=1)
+    area_b = np.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=1)
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def centroid_distances(boxes_a, boxes_b):
+    """Pairwise centroid distances, relative to the diagonal of the first boxes."""
+    boxes_a = np.asarray(boxes_a, dtype=float).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=float).reshape(-1, 4)
+    centroids_a = (boxes_a[:, :2] + boxes_a[:, 2:]) / 2
+    centroids_b = (boxes_b[:, :2] + boxes_b[:, 2:]) / 2
+    diagonals = np.maximum(np.linalg.norm(boxes_a[:, 2:] - boxes_a[:, :2], axis=1), 1e-6)
+    return np.linalg.norm(centroids_a[:, None] - centroids_b[None], axis=2) / diagonals[:, None]
+
+
+class IoUTracker:
+    """Greedy IoU tracker with a centroid distance fallback.
+
+    A detection continues the track of the same class it overlaps most, or
+    whose centroid is close enough when the boxes barely overlap. Every track
+    remembers its anchor, the frame and box its text was last read from. A
+    detection is re-anchored, and its text read again, when it starts a new
+    track or has moved away from its anchor box.
+    """
+
+    def __init__(self, iou_threshold=0.3, centroid_threshold=0.5, reuse_iou=0.8, max_age=3):
+        """Constructor.
+
+        :param iou_threshold: Minimum IoU to continue a track.
+        :param centroid_threshold: Maximum centroid distance, relative to the
+            track's box diagonal, to continue a track without enough overlap.
+        :param reuse_iou: Minimum IoU with the anchor box to reuse its text.
+        :param max_age: Frames a track survives without a detection.
+        """
+        self.iou_threshold = iou_threshold
+        self.centroid_threshold = centroid_threshold
+        self.reuse_iou = reuse_iou
+        self.max_age = max_age
+        self._ids = itertools.count()
+        self._tracks = []  # dicts with id, class_name, box, anchor and age
+
+    def update(self, frame_id, detections):
+        """Assign the ``(class_name, bbox)`` detections of the next frame to tracks.
+
+        Returns ``(track_id, anchor_frame_id, anchor_bbox)`` per detection. The
+        anchor frame is ``frame_id`` when the detection's text must be read.
+        """
+        boxes = [bbox for _, bbox in detections]
+        assignment = [None] * len(detections)
+        if self._tracks and detections:
+            track_boxes = [track["box"] for track in self._tracks]
+            ious = iou_matrix(track_boxes, boxes)
+            distances = centroid_distances(track_boxes, boxes)
+            same_class = np.array([
+                [track["class_name"] == class_name for class_name, _ in detections]
+                for track in self._tracks
+            ])
+            valid = same_class & ((ious >= self.iou_threshold) | (distances <= self.centroid_threshold))
+            # Best overlaps first, closest centroids breaking ties.
+            order = np.lexsort((distances.ravel(), -ious.ravel()))
+            used_tracks = set()
+            for flat_index in order:
+                track_index, detection_index = divmod(int(flat_index), len(detections))
+                if not valid[track_index, detection_index] or track_index in used_tracks \
+                        or assignment[detection_index] is not None:
+                    continue
+                used_tracks.add(track_index)
+                assignment[detection_index] = self._tracks[track_index]
+
+        tracks = []
+        results = []
+        for (class_name, bbox), track in zip(detections, assignment):
+            if track is None:
+                track = {"id": next(self._ids), "class_name": class_name, "anchor": (frame_id, bbox)}
+            elif iou_matrix([track["anchor"][1]], [bbox])[0, 0] < self.reuse_iou:
+                track["anchor"] = (frame_id, bbox)
+            track["box"] = bbox
+            track["age"] = 0
+            tracks.append(track)
+            results.append((track["id"], *track["anchor"]))
+
+        matched = {track["id"] for track in tracks}
+        for track in self._tracks:
+            if track["id"] not in matched:
+                track["age"] += 1
+                if track["age"] <= self.max_age:
+                    tracks.append(track)
+        self._tracks = tracks
+        return results
+
+
+def assign_tracks(frame_ids, frame_detections, **tracker_options):
+    """Track the detections of consecutive frames.
+
+    ``frame_detections`` maps every frame id to its ``(class_name, bbox)``
+    detections. Returns the ``IoUTracker.update`` output of every frame.
+    """
+    tracker = IoUTracker(**tracker_options)
+    return {frame_id: tracker.update(frame_id, frame_detections[frame_id]) for frame_id in frame_ids}
@@ -1,3 +1,5 @@
+import base64
+import io
 import logging
 import os
 import subprocess
@@ -5,6 +7,8 @@ import sys
 
 from typing import List
 
+from PIL import Image
+
 logger = logging.getLogger(__name__)
 
 
@@ -35,3 +39,27 @@ def check_and_create(path):
     """Check and create the path."""
     os.makedirs(path, exist_ok=True)
     return path
+
+
+def encode_jpeg(image):
+    """JPEG bytes of an image path, PIL image or encoded image bytes.
+
+    Bytes that already hold a JPEG are returned as they are.
+    """
+    if isinstance(image, bytes):
+        if image.startswith(b"\xff\xd8\xff"):
+            return image
+        image = io.BytesIO(image)
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    buf = io.BytesIO() #temporary buffer to save image
+    image.convert("RGB").save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+def inline_image(image_bytes, max_length):
+    """Base64 data URL of JPEG bytes, None if it is longer than ``max_length`` characters."""
+    encoded = base64.b64encode(image_bytes).decode("ascii")
+    if len(encoded) > max_length:
+        return None
+    return f"data:image/jpeg;base64,{encoded}"